@@ -1,15 +1,24 @@
 """
 Song Generation API - Generate instrumental music from prompts
 """
-from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks
-from pydantic import BaseModel, Field
+from fastapi import APIRouter, HTTPException, Depends, BackgroundTasks, Response
+from pydantic import BaseModel, Field, field_validator
 from typing import Optional
 import logging
+import math
 
-from workers.song_tasks import generate_song_task
+from workers.song_tasks import submit_song_generation
+from workers.stem_tasks import request_stems
 from models.user import get_current_user, User
 from models.track import TrackCreate, TrackResponse
 from services.supabase_client import supabase
+from services.model_registry import (
+    resolve_model_id,
+    list_models as list_registry_models
+)
+from services.eta_service import estimate_eta
+from utils.config import get_max_generation_eta
+from services.encoding_service import select_rendition
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -20,12 +29,21 @@ class SongGenerateRequest(BaseModel):
     duration: int = Field(30, ge=10, le=180, description="Duration in seconds")
     model: str = Field("musicgen-medium", description="Model to use")
     temperature: float = Field(1.0, ge=0.1, le=2.0)
+    seed: Optional[int] = Field(None, ge=0, description="Seed for reproducible generation")
+    num_return_sequences: int = Field(1, ge=1, le=4, description="Candidates to generate; the best becomes the track")
+    
+    @field_validator('model')
+    @classmethod
+    def validate_model(cls, v: str) -> str:
+        """Resolve to a registered model id before anything is queued"""
+        return resolve_model_id(v)
 
 
 class SongGenerateResponse(BaseModel):
     task_id: str
     status: str
     estimated_time: int
+    queue_position: int
     message: str
 
 
@@ -59,6 +77,17 @@ async def generate_song(
                 detail="Generation quota exceeded. Please upgrade your plan."
             )
         
+        # ETA from measured decode rates and the live depth of the model's queue
+        eta = estimate_eta(request.model, request.duration)
+        
+        max_eta = get_max_generation_eta()
+        if max_eta and eta["eta_seconds"] > max_eta:
+            raise HTTPException(
+                status_code=503,
+                detail=f"Generation queue is full (estimated wait {eta['eta_seconds']:.0f}s). Please retry later.",
+                headers={"Retry-After": str(int(eta["eta_seconds"] - max_eta) + 1)}
+            )
+        
         # Create track record
         track_data = {
             "user_id": current_user.id,
@@ -72,13 +101,16 @@ async def generate_song(
         track_result = supabase.table("tracks").insert(track_data).execute()
         track_id = track_result.data[0]["id"]
         
-        # Queue generation task
-        task = generate_song_task.delay(
+        # Queue generation task (may be collected into a batch)
+        task_id = submit_song_generation(
             track_id=track_id,
             prompt=request.prompt,
             duration=request.duration,
             model=request.model,
-            temperature=request.temperature
+            temperature=request.temperature,
+            seed=request.seed,
+            tier=tier,
+            num_return_sequences=request.num_return_sequences
         )
         
         # Update generation count
@@ -86,12 +118,11 @@ async def generate_song(
             "generation_count": count + 1
         }).eq("id", current_user.id).execute()
         
-        estimated_time = request.duration * 2  # Rough estimate
-        
         return SongGenerateResponse(
-            task_id=task.id,
+            task_id=task_id,
             status="queued",
-            estimated_time=estimated_time,
+            estimated_time=math.ceil(eta["eta_seconds"]),
+            queue_position=eta["queue_position"],
             message=f"Your track is being generated. Track ID: {track_id}"
         )
     
@@ -123,6 +154,7 @@ async def get_generation_status(
     if task.state == "PROGRESS":
         response["progress"] = task.info.get("progress", 0)
         response["message"] = task.info.get("message", "")
+        response["chunk_urls"] = task.info.get("chunk_urls", [])
     elif task.state == "SUCCESS":
         response["progress"] = 100
         response["result"] = task.info
@@ -132,33 +164,98 @@ async def get_generation_status(
     return response
 
 
+@router.get("/tracks/{track_id}/audio")
+async def get_track_audio(
+    track_id: str,
+    output: str = "master",
+    lossless: bool = False,
+    formats: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get the smallest rendition of a track output that suits the client
+    
+    output is master, mastered, mixed, vocals or stems/<name>; formats is an
+    optional comma-separated list of formats the client can play, and
+    lossless restricts the choice to FLAC/WAV.
+    """
+    track = supabase.table("tracks").select("audio_url, audio_urls").eq("id", track_id).eq("user_id", current_user.id).single().execute()
+    
+    if not track.data:
+        raise HTTPException(status_code=404, detail="Track not found")
+    
+    renditions = (track.data.get("audio_urls") or {}).get(output)
+    if not renditions and output == "master" and track.data.get("audio_url"):
+        # Tracks generated before renditions were uploaded
+        renditions = {"wav": track.data["audio_url"]}
+    
+    if not renditions:
+        raise HTTPException(status_code=404, detail=f"No audio for output '{output}'")
+    
+    accepted_formats = [f.strip().lower() for f in formats.split(",")] if formats else None
+    selected = select_rendition(renditions, lossless=lossless, accepted_formats=accepted_formats)
+    
+    if selected is None:
+        raise HTTPException(status_code=406, detail="No rendition matches the requested formats")
+    
+    audio_format, url = selected
+    
+    return {
+        "track_id": track_id,
+        "output": output,
+        "format": audio_format,
+        "url": url,
+        "renditions": renditions
+    }
+
+
+@router.get("/tracks/{track_id}/stems")
+async def get_track_stems(
+    track_id: str,
+    response: Response,
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Get a track's stems, separating them on first request
+    
+    Stems are cached on the track row once separated. Until then this
+    queues separation on the low-priority stems queue (once per track)
+    and answers 202 with the task id to poll via /status/{task_id}.
+    """
+    track = supabase.table("tracks").select("audio_url, stem_urls, audio_urls").eq("id", track_id).eq("user_id", current_user.id).single().execute()
+    
+    if not track.data:
+        raise HTTPException(status_code=404, detail="Track not found")
+    
+    # Mastering and vocals change the status but keep the generated master
+    if not track.data.get("audio_url"):
+        raise HTTPException(status_code=409, detail="Stems are available once the track has finished generating")
+    
+    stem_urls = track.data.get("stem_urls")
+    if stem_urls:
+        audio_urls = track.data.get("audio_urls") or {}
+        return {
+            "track_id": track_id,
+            "status": "completed",
+            "stem_urls": stem_urls,
+            "renditions": {name: audio_urls.get(f"stems/{name}", {}) for name in stem_urls}
+        }
+    
+    task_id = request_stems(track_id)
+    response.status_code = 202
+    
+    return {
+        "track_id": track_id,
+        "status": "processing",
+        "task_id": task_id
+    }
+
+
 @router.get("/models")
 async def list_models():
     """
     List available music generation models
     """
     return {
-        "models": [
-            {
-                "id": "musicgen-small",
-                "name": "MusicGen Small",
-                "description": "Fast generation, good quality",
-                "max_duration": 30,
-                "speed": "fast"
-            },
-            {
-                "id": "musicgen-medium",
-                "name": "MusicGen Medium",
-                "description": "Balanced quality and speed",
-                "max_duration": 60,
-                "speed": "medium"
-            },
-            {
-                "id": "musicgen-large",
-                "name": "MusicGen Large",
-                "description": "Highest quality, slower",
-                "max_duration": 180,
-                "speed": "slow"
-            }
-        ]
+        "models": list_registry_models()
     }
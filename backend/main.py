@@ -136,6 +136,13 @@ async def health_check():
         health_status["checks"]["redis"] = f"error: {str(e)}"
         health_status["status"] = "degraded"
     
+    # Model cache hit/miss counters published by generation workers
+    try:
+        from services.worker_stats import get_model_cache_stats_by_worker
+        health_status["model_cache"] = get_model_cache_stats_by_worker()
+    except Exception as e:
+        health_status["model_cache"] = f"error: {str(e)}"
+    
     return health_status
 
 
@@ -16,6 +16,13 @@ class TrackStatus(str, Enum):
     FAILED = "failed"
 
 
+class StemsStatus(str, Enum):
+    QUEUED = "queued"
+    PROCESSING = "processing"
+    COMPLETED = "completed"
+    FAILED = "failed"
+
+
 class TrackType(str, Enum):
     INSTRUMENTAL = "instrumental"
     VOCAL = "vocal"
@@ -43,6 +50,9 @@ class TrackUpdate(BaseModel):
     mastered_url: Optional[str] = None
     vocal_url: Optional[str] = None
     stem_urls: Optional[Dict[str, str]] = None
+    stems_status: Optional[StemsStatus] = None
+    alternate_urls: Optional[List[str]] = None
+    audio_urls: Optional[Dict[str, Dict[str, str]]] = None
     grammy_score: Optional[float] = None
 
 
@@ -54,6 +64,9 @@ class TrackResponse(TrackBase):
     mastered_url: Optional[str] = None
     vocal_url: Optional[str] = None
     stem_urls: Optional[Dict[str, str]] = None
+    stems_status: Optional[StemsStatus] = None
+    alternate_urls: Optional[List[str]] = None
+    audio_urls: Optional[Dict[str, Dict[str, str]]] = None
     grammy_score: Optional[float] = None
     has_vocals: bool = False
     type: TrackType
@@ -0,0 +1,154 @@
+"""
+Demucs Separator - Neural stem separation on CPU in overlapping chunks
+Peak memory is bounded by the chunk length, not the track length
+"""
+import torch
+import numpy as np
+from math import gcd
+from scipy.signal import resample_poly
+from typing import Dict
+import time
+import logging
+from utils.config import get_stem_model, get_stem_chunk_seconds
+
+logger = logging.getLogger(__name__)
+
+# Overlap between consecutive chunks, crossfaded linearly when summed
+CHUNK_OVERLAP_SECONDS = 1.0
+
+# Overlap of Demucs' own segments inside each chunk
+SEGMENT_OVERLAP = 0.25
+
+# Loaded separation models by name, reused across tasks like the MusicGen cache
+_separator_models = {}
+
+
+def _import_demucs():
+    try:
+        from demucs.apply import apply_model
+        from demucs.pretrained import get_model
+    except ImportError:
+        raise RuntimeError("STEM_SEPARATOR=demucs requires the demucs package")
+    return apply_model, get_model
+
+
+def get_separator_model(model_name: str = None):
+    """
+    Load and cache a pretrained Demucs model
+    """
+    if model_name is None:
+        model_name = get_stem_model()
+    
+    if model_name not in _separator_models:
+        _, get_model = _import_demucs()
+        
+        logger.info(f"Loading separation model: {model_name}")
+        model = get_model(model_name)
+        model.eval()
+        _separator_models[model_name] = model
+    
+    return _separator_models[model_name]
+
+
+def _resample(audio: np.ndarray, from_rate: int, to_rate: int) -> np.ndarray:
+    if from_rate == to_rate:
+        return audio
+    divisor = gcd(from_rate, to_rate)
+    return resample_poly(audio, to_rate // divisor, from_rate // divisor, axis=-1).astype(np.float32)
+
+
+def _separate_chunk(model, chunk: np.ndarray, sample_rate: int, mean: float, std: float) -> np.ndarray:
+    """
+    Run Demucs on one chunk (channels x samples) at the chunk's sample rate
+    
+    Returns:
+        Sources x channels x samples, resampled back to sample_rate
+    """
+    apply_model, _ = _import_demucs()
+    num_channels, num_samples = chunk.shape
+    
+    # Demucs expects its own channel count and sample rate
+    model_input = chunk
+    if num_channels != model.audio_channels:
+        model_input = np.repeat(chunk.mean(axis=0, keepdims=True), model.audio_channels, axis=0)
+    model_input = _resample(model_input, sample_rate, model.samplerate)
+    
+    with torch.inference_mode():
+        sources = apply_model(
+            model,
+            torch.from_numpy((model_input - mean) / std)[None],
+            shifts=0,
+            split=True,
+            overlap=SEGMENT_OVERLAP,
+            progress=False
+        )[0].numpy() * std + mean
+    
+    sources = _resample(sources, model.samplerate, sample_rate)[..., :num_samples]
+    if num_channels != model.audio_channels:
+        sources = sources.mean(axis=1, keepdims=True)
+    
+    # Resampling filters can leave the output a few samples short
+    if sources.shape[-1] < num_samples:
+        sources = np.pad(sources, ((0, 0), (0, 0), (0, num_samples - sources.shape[-1])))
+    
+    return sources
+
+
+def separate(audio_array: np.ndarray, sample_rate: int) -> Dict[str, np.ndarray]:
+    """
+    Separate audio into the model's sources (drums, bass, other, vocals)
+    
+    The track is processed in STEM_CHUNK_SECONDS chunks that overlap by
+    CHUNK_OVERLAP_SECONDS and are crossfaded into output buffers at the
+    input sample rate, so only one chunk is ever resampled and run through
+    the model at a time.
+    
+    Args:
+        audio_array: Float audio (samples, or samples x channels)
+        sample_rate: Sample rate of audio_array
+    
+    Returns:
+        Dictionary mapping source name to audio shaped like audio_array
+    """
+    model = get_separator_model()
+    start_time = time.time()
+    
+    channels = np.atleast_2d(audio_array.T).astype(np.float32)
+    num_samples = channels.shape[1]
+    
+    chunk_samples = max(int(get_stem_chunk_seconds() * sample_rate), 2 * int(CHUNK_OVERLAP_SECONDS * sample_rate))
+    overlap_samples = min(int(CHUNK_OVERLAP_SECONDS * sample_rate), chunk_samples // 2)
+    hop = chunk_samples - overlap_samples
+    
+    # Normalize with whole-track statistics so every chunk sees the same gain
+    mean = float(channels.mean())
+    std = float(channels.std()) or 1.0
+    
+    output = np.zeros((len(model.sources),) + channels.shape, dtype=np.float32)
+    weight = np.zeros(num_samples, dtype=np.float32)
+    fade = np.linspace(0.0, 1.0, overlap_samples + 2, dtype=np.float32)[1:-1]
+    
+    for offset in range(0, max(num_samples - overlap_samples, 1), hop):
+        end = min(offset + chunk_samples, num_samples)
+        sources = _separate_chunk(model, channels[:, offset:end], sample_rate, mean, std)
+        
+        window = np.ones(end - offset, dtype=np.float32)
+        if offset > 0:
+            window[:overlap_samples] = fade[:end - offset]
+        if end < num_samples:
+            window[-overlap_samples:] = np.minimum(window[-overlap_samples:], fade[::-1])
+        
+        output[..., offset:end] += sources * window
+        weight[offset:end] += window
+    
+    output /= np.maximum(weight, np.finfo(np.float32).tiny)
+    
+    logger.info(
+        f"Separated {num_samples / sample_rate:.1f}s of audio with {get_stem_model()} "
+        f"in {time.time() - start_time:.1f}s"
+    )
+    
+    return {
+        name: source.T if audio_array.ndim > 1 else source[0]
+        for name, source in zip(model.sources, output)
+    }
@@ -0,0 +1,288 @@
+"""
+Encoding Service - Compressed renditions of generated and processed audio
+FLAC for lossless archival plus Opus/MP3 previews, encoded and uploaded in parallel
+"""
+import io
+import logging
+import os
+import tempfile
+import time
+import numpy as np
+import soundfile as sf
+from concurrent.futures import ThreadPoolExecutor
+from math import gcd
+from scipy.signal import resample_poly
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+from services.supabase_client import upload_audio_file_sync
+from utils.config import get_audio_buffer_size, get_audio_renditions, get_encoding_workers, get_upload_retries
+
+logger = logging.getLogger(__name__)
+
+# soundfile container and subtype, MIME type and file extension per format
+AUDIO_FORMATS = {
+    "wav": {"container": "WAV", "subtype": "PCM_16", "content_type": "audio/wav", "extension": "wav"},
+    "flac": {"container": "FLAC", "subtype": "PCM_16", "content_type": "audio/flac", "extension": "flac"},
+    "ogg": {"container": "OGG", "subtype": "VORBIS", "content_type": "audio/ogg", "extension": "ogg"},
+    "opus": {"container": "OGG", "subtype": "OPUS", "content_type": "audio/ogg", "extension": "opus"},
+    "mp3": {"container": "MP3", "subtype": "MPEG_LAYER_III", "content_type": "audio/mpeg", "extension": "mp3"}
+}
+
+LOSSLESS_FORMATS = ("wav", "flac")
+
+# Formats from smallest to largest at their default settings
+FORMATS_BY_SIZE = ("opus", "mp3", "ogg", "flac", "wav")
+
+# Opus only encodes at these rates; other audio is resampled to 48 kHz
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+
+# Seconds before the first upload retry, doubled on each further attempt
+UPLOAD_RETRY_BACKOFF = 1.0
+
+
+def _validate_format(audio_format: str):
+    if audio_format not in AUDIO_FORMATS:
+        raise ValueError(
+            f"Unknown audio format '{audio_format}'. Available formats: {', '.join(AUDIO_FORMATS)}"
+        )
+
+
+def encode_audio(audio_array: np.ndarray, sample_rate: int, audio_format: str = "wav") -> bytes:
+    """
+    Encode float audio (samples, or samples x channels) in memory
+    """
+    _validate_format(audio_format)
+    spec = AUDIO_FORMATS[audio_format]
+    
+    if audio_format == "opus" and sample_rate not in OPUS_SAMPLE_RATES:
+        divisor = gcd(48000, sample_rate)
+        audio_array = resample_poly(audio_array, 48000 // divisor, sample_rate // divisor, axis=0)
+        sample_rate = 48000
+    
+    buffer = io.BytesIO()
+    sf.write(
+        buffer,
+        np.clip(audio_array, -1.0, 1.0).astype(np.float32),
+        sample_rate,
+        format=spec["container"],
+        subtype=spec["subtype"]
+    )
+    return buffer.getvalue()
+
+
+def _resample_blocks(blocks: Iterator[np.ndarray], from_rate: int, to_rate: int) -> Iterator[np.ndarray]:
+    """
+    Resample a stream of (frames x channels) blocks with resample_poly
+    
+    Each segment is resampled with enough input context on both sides for
+    the polyphase filter, and segments start on whole input periods, so the
+    output matches resampling the whole signal at once.
+    """
+    divisor = gcd(from_rate, to_rate)
+    up, down = to_rate // divisor, from_rate // divisor
+    
+    # resample_poly's filter reaches 10 * max(up, down) upsampled samples each way
+    context = -(-(10 * max(up, down) // up + 1) // down) * down
+    
+    buffer = None
+    buffer_start = 0  # input frame of buffer[0]
+    emitted = 0  # input frames already resampled
+    
+    def resample(end: int, last: bool) -> np.ndarray:
+        segment_start = max(emitted - context, 0)
+        segment = buffer[segment_start - buffer_start:]
+        if not last:
+            segment = segment[:end + context - segment_start]
+        resampled = resample_poly(segment, up, down, axis=0)
+        offset = (emitted - segment_start) * up // down
+        count = (end - emitted) * up // down if not last else len(resampled) - offset
+        return resampled[offset:offset + count].astype(np.float32)
+    
+    for block in blocks:
+        buffer = block if buffer is None else np.concatenate([buffer, block])
+        
+        end = (buffer_start + len(buffer) - context) // down * down
+        if end <= emitted:
+            continue
+        
+        yield resample(end, last=False)
+        emitted = end
+        
+        # Keep only the context the next segment still needs
+        keep_from = emitted - context - buffer_start
+        if keep_from > 0:
+            buffer = buffer[keep_from:]
+            buffer_start += keep_from
+    
+    if buffer is not None and buffer_start + len(buffer) > emitted:
+        yield resample(buffer_start + len(buffer), last=True)
+
+
+def encode_file(audio_path: str, output_path: str, audio_format: str):
+    """
+    Encode an audio file into another format block by block, so memory
+    stays flat regardless of track length
+    """
+    _validate_format(audio_format)
+    spec = AUDIO_FORMATS[audio_format]
+    
+    with sf.SoundFile(audio_path) as source:
+        sample_rate = source.samplerate
+        blocks = source.blocks(blocksize=get_audio_buffer_size(), dtype="float32", always_2d=True)
+        if audio_format == "opus" and sample_rate not in OPUS_SAMPLE_RATES:
+            blocks = _resample_blocks(blocks, sample_rate, 48000)
+            sample_rate = 48000
+        
+        with sf.SoundFile(
+            output_path, "w",
+            samplerate=sample_rate,
+            channels=source.channels,
+            format=spec["container"],
+            subtype=spec["subtype"]
+        ) as output:
+            for block in blocks:
+                output.write(np.clip(block, -1.0, 1.0))
+
+
+def _upload_with_retries(file_data: Union[bytes, str], filename: str, content_type: str) -> str:
+    """
+    Upload a file, retrying transient failures UPLOAD_RETRIES times with backoff
+    """
+    retries = get_upload_retries()
+    for attempt in range(retries + 1):
+        try:
+            return upload_audio_file_sync(file_data=file_data, filename=filename, content_type=content_type)
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = UPLOAD_RETRY_BACKOFF * 2 ** attempt
+            logger.warning(f"Upload of {filename} failed (attempt {attempt + 1}), retrying in {delay:.0f}s: {e}")
+            time.sleep(delay)
+
+
+def upload_encoded_outputs(
+    outputs: Dict[str, Dict],
+    primary: bool = True,
+    renditions: bool = True
+) -> Dict[str, Dict[str, str]]:
+    """
+    Upload several in-memory encoded outputs and their renditions concurrently
+    
+    Every (output, format) pair is one job on a single ENCODING_WORKERS pool,
+    primary formats first, so upload wall time no longer grows linearly
+    with the number of outputs (e.g. stems). Each upload is retried on its
+    own; a rendition that still fails is left out, while an output whose
+    primary format cannot be uploaded fails the call once the other jobs
+    have finished.
+    
+    Args:
+        outputs: Storage path without extension -> in-memory audio (see
+            musicgen_service._encode_audio), or {"path", "format"} for an
+            encoded file, which is encoded and uploaded from disk
+        primary: Upload each output's own encoded data
+        renditions: Encode and upload the AUDIO_RENDITIONS formats
+    
+    Returns:
+        Dictionary mapping storage path to format -> public URL
+    """
+    rendition_formats = get_audio_renditions() if renditions else []
+    for audio_format in rendition_formats:
+        _validate_format(audio_format)
+    
+    jobs = [(storage_path, audio["format"]) for storage_path, audio in outputs.items()] if primary else []
+    jobs += [
+        (storage_path, audio_format)
+        for storage_path, audio in outputs.items()
+        for audio_format in rendition_formats
+        if audio_format != audio["format"]
+    ]
+    if not jobs:
+        return {}
+    
+    def encode_and_upload(storage_path: str, audio_format: str) -> str:
+        audio = outputs[storage_path]
+        spec = AUDIO_FORMATS[audio_format]
+        filename = f"{storage_path}.{spec['extension']}"
+        
+        if "path" not in audio:
+            if audio_format == audio["format"]:
+                file_data = audio["data"]
+            else:
+                file_data = encode_audio(audio["audio"], audio["sample_rate"], audio_format)
+            return _upload_with_retries(file_data, filename, spec["content_type"])
+        
+        if audio_format == audio["format"]:
+            return _upload_with_retries(audio["path"], filename, spec["content_type"])
+        
+        fd, encoded_path = tempfile.mkstemp(suffix=f".{spec['extension']}", prefix="grammy_rendition_")
+        os.close(fd)
+        try:
+            encode_file(audio["path"], encoded_path, audio_format)
+            return _upload_with_retries(encoded_path, filename, spec["content_type"])
+        finally:
+            os.remove(encoded_path)
+    
+    urls = {storage_path: {} for storage_path in outputs}
+    failed = []
+    with ThreadPoolExecutor(max_workers=min(len(jobs), get_encoding_workers())) as pool:
+        futures = {job: pool.submit(encode_and_upload, *job) for job in jobs}
+        
+        for (storage_path, audio_format), future in futures.items():
+            try:
+                urls[storage_path][audio_format] = future.result()
+            except Exception as e:
+                logger.warning(f"{audio_format} upload of {storage_path} failed: {e}")
+                if audio_format == outputs[storage_path]["format"]:
+                    failed.append(storage_path)
+    
+    if failed:
+        raise RuntimeError(f"Upload failed for {', '.join(failed)}")
+    
+    logger.info(f"Uploaded {len(outputs)} outputs in {len(jobs)} files")
+    
+    return urls
+
+
+def upload_encoded_audio(
+    storage_path: str,
+    audio: Dict,
+    primary: bool = True,
+    renditions: bool = True
+) -> Dict[str, str]:
+    """
+    Upload in-memory encoded audio and its AUDIO_RENDITIONS, returning format -> URL
+    """
+    return upload_encoded_outputs({storage_path: audio}, primary, renditions).get(storage_path, {})
+
+
+def upload_file_renditions(storage_path: str, audio_path: str, primary_format: str = "wav") -> Dict[str, str]:
+    """
+    Encode and upload the AUDIO_RENDITIONS of an audio file whose primary
+    format the caller already uploaded (see upload_encoded_outputs)
+    
+    Renditions are encoded block by block into temporary files that are
+    streamed to storage, so the file is never read into memory whole.
+    """
+    return upload_encoded_audio(storage_path, {"path": audio_path, "format": primary_format}, primary=False)
+
+
+def select_rendition(
+    renditions: Dict[str, str],
+    lossless: bool = False,
+    accepted_formats: Optional[List[str]] = None
+) -> Optional[Tuple[str, str]]:
+    """
+    Pick the smallest rendition that suits the client
+    
+    Returns:
+        (format, url), or None if no rendition qualifies
+    """
+    for audio_format in FORMATS_BY_SIZE:
+        if audio_format not in renditions:
+            continue
+        if lossless and audio_format not in LOSSLESS_FORMATS:
+            continue
+        if accepted_formats and audio_format not in accepted_formats:
+            continue
+        return audio_format, renditions[audio_format]
+    
+    return None
@@ -0,0 +1,199 @@
+"""
+ETA Service - Generation cost model calibrated from measured decode rates
+Kept free of torch imports so the API can estimate queue times cheaply
+"""
+import socket
+import logging
+from typing import Dict, Optional
+from services.model_registry import (
+    get_batch_collector_prefix,
+    get_checkpoint_name,
+    get_generation_queue,
+    tokens_for_duration
+)
+from services.redis_client import get_redis
+from utils.config import get_model_backend, get_model_precision, get_worker_concurrency
+
+logger = logging.getLogger(__name__)
+
+# Weight of a new measurement in the moving averages
+EWMA_WEIGHT = 0.3
+
+# Each host's rate has its own key, so hosts that stop reporting (e.g.
+# replaced containers) drop out of the estimate after this long
+RATE_TTL_SECONDS = 24 * 3600
+
+# Fallback when no decode rate has been measured yet (the old heuristic)
+UNCALIBRATED_SECONDS_PER_AUDIO_SECOND = 2.0
+
+
+def _rate_prefix(model_name: str) -> str:
+    return f"grammy:decode_rates:{model_name}:"
+
+
+def _overhead_key(model_name: str) -> str:
+    return f"grammy:job_overhead:{model_name}"
+
+
+def _ewma(previous: Optional[bytes], value: float) -> float:
+    if previous is None:
+        return value
+    return (1 - EWMA_WEIGHT) * float(previous) + EWMA_WEIGHT * value
+
+
+def record_decode_rate(model_name: str, steps_per_second: float, frame_rate: int, num_codebooks: int):
+    """
+    Fold a measured single-track decode rate into this host's average
+    
+    The host's backend, precision, pool size and the model's token layout
+    are stored with the rate, so the API estimates from what the workers
+    actually run rather than from its own configuration.
+    """
+    try:
+        redis = get_redis()
+        key = _rate_prefix(model_name) + socket.gethostname()
+        redis.hset(key, mapping={
+            "rate": _ewma(redis.hget(key, "rate"), steps_per_second),
+            "backend": get_model_backend(),
+            "precision": get_model_precision(),
+            "concurrency": get_worker_concurrency(),
+            "frame_rate": frame_rate,
+            "num_codebooks": num_codebooks
+        })
+        redis.expire(key, RATE_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Decode rate not recorded: {e}")
+
+
+def get_decode_rates(model_name: str) -> Dict[str, Dict]:
+    """
+    Measured decode rates by worker host
+    
+    Returns:
+        Dictionary mapping host to its rate (steps per second), backend,
+        precision, concurrency, frame_rate and num_codebooks
+    """
+    prefix = _rate_prefix(model_name)
+    try:
+        redis = get_redis()
+        keys = list(redis.scan_iter(match=f"{prefix}*"))
+        pipe = redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        samples = pipe.execute() if keys else []
+    except Exception as e:
+        logger.warning(f"Decode rate lookup failed: {e}")
+        return {}
+    
+    rates = {}
+    for key, sample in zip(keys, samples):
+        # Keys can expire between the scan and the read
+        if not sample or b"rate" not in sample:
+            continue
+        sample = {field.decode(): value.decode() for field, value in sample.items()}
+        rates[key.decode()[len(prefix):]] = {
+            "rate": float(sample["rate"]),
+            "backend": sample.get("backend"),
+            "precision": sample.get("precision"),
+            "concurrency": int(sample.get("concurrency", 1)),
+            "frame_rate": int(sample.get("frame_rate", 50)),
+            "num_codebooks": int(sample.get("num_codebooks", 4))
+        }
+    return rates
+
+
+def _decode_seconds(rates: Dict[str, Dict], duration: float) -> Optional[float]:
+    if not rates:
+        return None
+    
+    # Hosts may run different backends or precisions; each contributes its own rate
+    seconds = [
+        tokens_for_duration(duration, host["frame_rate"], host["num_codebooks"]) / host["rate"]
+        for host in rates.values()
+    ]
+    return sum(seconds) / len(seconds)
+
+
+def estimate_decode_seconds(model_name: str, duration: float) -> Optional[float]:
+    """
+    Seconds to decode a track of this duration, averaged over reporting hosts
+    """
+    return _decode_seconds(get_decode_rates(model_name), duration)
+
+
+def record_job_time(model_name: str, duration: float, seconds: float):
+    """
+    Record a finished generation job's wall time
+    
+    The part not explained by decoding (prompt encoding, audio encoding, uploads) is
+    averaged as per-job overhead.
+    """
+    decode_seconds = estimate_decode_seconds(model_name, duration)
+    if decode_seconds is None:
+        return
+    
+    try:
+        redis = get_redis()
+        key = _overhead_key(model_name)
+        redis.set(key, _ewma(redis.get(key), max(0.0, seconds - decode_seconds)), ex=RATE_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Job time not recorded: {e}")
+
+
+def get_queue_depth(queue: str, collector_prefix: Optional[str] = None) -> int:
+    """
+    Jobs waiting in a Celery queue (the broker keeps each queue as a Redis
+    list) plus those held in batch collector lists under collector_prefix
+    """
+    try:
+        redis = get_redis()
+        depth = int(redis.llen(queue))
+        if collector_prefix:
+            for key in redis.scan_iter(match=f"{collector_prefix}*"):
+                depth += int(redis.llen(key))
+        return depth
+    except Exception as e:
+        logger.warning(f"Queue depth lookup failed for {queue}: {e}")
+        return 0
+
+
+def estimate_eta(model: Optional[str], duration: float) -> Dict:
+    """
+    Estimate when a new job for a model would finish and where it would sit
+    in its queue
+    
+    Jobs ahead are assumed to be like this one and are shared among the
+    worker processes of every host that has reported a decode rate.
+    
+    Returns:
+        Dictionary with eta_seconds, queue_position, queue_depth, workers
+        and calibrated (False while no rate has been measured)
+    """
+    model_name = get_checkpoint_name(model)
+    queue_depth = get_queue_depth(get_generation_queue(model), get_batch_collector_prefix(model))
+    rates = get_decode_rates(model_name)
+    
+    # Pool sizes as reported by the workers; a guess until one has reported
+    workers = sum(host["concurrency"] for host in rates.values()) or get_worker_concurrency()
+    
+    decode_seconds = _decode_seconds(rates, duration)
+    if decode_seconds is None:
+        job_seconds = duration * UNCALIBRATED_SECONDS_PER_AUDIO_SECOND
+    else:
+        try:
+            overhead = get_redis().get(_overhead_key(model_name))
+        except Exception as e:
+            logger.warning(f"Job overhead lookup failed: {e}")
+            overhead = None
+        job_seconds = decode_seconds + (float(overhead) if overhead is not None else 0.0)
+    
+    # Full rounds of the worker pool before this job starts
+    rounds_ahead = queue_depth // max(1, workers)
+    
+    return {
+        "eta_seconds": (rounds_ahead + 1) * job_seconds,
+        "queue_position": queue_depth + 1,
+        "queue_depth": queue_depth,
+        "workers": workers,
+        "calibrated": decode_seconds is not None
+    }
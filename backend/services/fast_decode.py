@@ -0,0 +1,413 @@
+"""
+Fast Decode - Static KV-cache MusicGen decoding loop for CPU inference
+Replaces generate()'s per-step cache concatenation with preallocated buffers
+and a single-step decoder that can be compiled once and reused
+"""
+import torch
+import torch.nn.functional as F
+import numpy as np
+from typing import Dict, Optional
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class StaticCacheDecoder(torch.nn.Module):
+    """
+    One MusicGen decoder step over preallocated self-attention KV buffers
+    
+    The step reads the cached keys and values and returns those of the
+    decoded position for the caller to write into the buffers, so the
+    step itself never mutates its inputs (in-place writes inside a compiled
+    graph cost a copy of the whole cache per step). Attending over the full
+    buffer with a mask gives every step identical tensor shapes, so the
+    step compiles once per buffer length.
+    """
+    
+    def __init__(self, musicgen_model):
+        super().__init__()
+        decoder = musicgen_model.decoder.model.decoder
+        
+        self.embed_tokens = decoder.embed_tokens
+        self.embed_positions = decoder.embed_positions
+        self.layers = decoder.layers
+        self.layer_norm = decoder.layer_norm
+        self.lm_heads = musicgen_model.decoder.lm_heads
+        self.num_codebooks = musicgen_model.decoder.num_codebooks
+        self.num_heads = musicgen_model.decoder.config.num_attention_heads
+        self.head_dim = musicgen_model.decoder.config.hidden_size // self.num_heads
+    
+    def _split_heads(self, states: torch.Tensor) -> torch.Tensor:
+        batch_size, length, _ = states.shape
+        return states.view(batch_size, length, self.num_heads, self.head_dim).transpose(1, 2)
+    
+    def _merge_heads(self, states: torch.Tensor) -> torch.Tensor:
+        batch_size, _, length, _ = states.shape
+        return states.transpose(1, 2).reshape(batch_size, length, self.num_heads * self.head_dim)
+    
+    def cross_attention_cache(self, encoder_hidden_states: torch.Tensor):
+        """
+        Project encoder states to cross-attention keys and values once per generation
+        """
+        keys = [self._split_heads(layer.encoder_attn.k_proj(encoder_hidden_states)) for layer in self.layers]
+        values = [self._split_heads(layer.encoder_attn.v_proj(encoder_hidden_states)) for layer in self.layers]
+        return torch.stack(keys), torch.stack(values)
+    
+    def forward(
+        self,
+        input_ids: torch.Tensor,
+        position: torch.Tensor,
+        key_cache: torch.Tensor,
+        value_cache: torch.Tensor,
+        cross_keys: torch.Tensor,
+        cross_values: torch.Tensor,
+        self_mask: torch.Tensor,
+        cross_mask: torch.Tensor
+    ):
+        """
+        Decode one position
+        
+        Args:
+            input_ids: (batch, num_codebooks) tokens at position
+            position: (1,) index of the position being decoded
+            key_cache: (layers, batch, heads, cached, head_dim) keys of earlier positions
+            value_cache: Same shape as key_cache
+            cross_keys: (layers, batch, heads, text_length, head_dim)
+            cross_values: Same shape as cross_keys
+            self_mask: (cached,) additive mask hiding cache slots not yet written
+            cross_mask: (batch, 1, 1, text_length) additive text padding mask
+        
+        Returns:
+            (batch, num_codebooks, vocab_size) logits for the next position,
+            and (layers, batch, heads, 1, head_dim) keys and values of this position
+        """
+        hidden_states = sum(
+            self.embed_tokens[codebook](input_ids[:, codebook]) for codebook in range(self.num_codebooks)
+        )[:, None]
+        hidden_states = hidden_states + self.embed_positions.weights.index_select(0, position)
+        
+        new_keys = []
+        new_values = []
+        
+        for index, layer in enumerate(self.layers):
+            # Causal self-attention over the cache plus this position
+            residual = hidden_states
+            hidden_states = layer.self_attn_layer_norm(hidden_states)
+            
+            attention = layer.self_attn
+            query = self._split_heads(attention.q_proj(hidden_states)) * attention.scaling
+            key = self._split_heads(attention.k_proj(hidden_states))
+            value = self._split_heads(attention.v_proj(hidden_states))
+            
+            scores = torch.cat([
+                torch.matmul(query, key_cache[index].transpose(-1, -2)) + self_mask,
+                (query * key).sum(dim=-1, keepdim=True)
+            ], dim=-1)
+            probs = scores.softmax(dim=-1)
+            attention_output = torch.matmul(probs[..., :-1], value_cache[index]) + probs[..., -1:] * value
+            
+            hidden_states = residual + attention.out_proj(self._merge_heads(attention_output))
+            new_keys.append(key)
+            new_values.append(value)
+            
+            # Cross-attention over the precomputed text keys and values
+            residual = hidden_states
+            hidden_states = layer.encoder_attn_layer_norm(hidden_states)
+            
+            attention = layer.encoder_attn
+            attention_output = F.scaled_dot_product_attention(
+                self._split_heads(attention.q_proj(hidden_states)),
+                cross_keys[index],
+                cross_values[index],
+                attn_mask=cross_mask
+            )
+            hidden_states = residual + attention.out_proj(self._merge_heads(attention_output))
+            
+            # Feed-forward
+            residual = hidden_states
+            hidden_states = layer.final_layer_norm(hidden_states)
+            hidden_states = layer.fc2(layer.activation_fn(layer.fc1(hidden_states)))
+            hidden_states = residual + hidden_states
+        
+        hidden_states = self.layer_norm(hidden_states)[:, 0]
+        logits = torch.stack([head(hidden_states) for head in self.lm_heads], dim=1)
+        
+        return logits, torch.stack(new_keys), torch.stack(new_values)
+
+
+def _sample(
+    logits: torch.Tensor,
+    do_sample: bool,
+    temperature: float,
+    top_k: Optional[int],
+    top_p: Optional[float]
+) -> torch.Tensor:
+    """
+    Pick next tokens from (rows, vocab) logits, warped in generate()'s order
+    """
+    if not do_sample:
+        return logits.argmax(dim=-1)
+    
+    if temperature is not None and temperature != 1.0:
+        logits = logits / temperature
+    
+    if top_k:
+        kth_largest = torch.topk(logits, min(top_k, logits.shape[-1])).values[..., -1:]
+        logits = logits.masked_fill(logits < kth_largest, float("-inf"))
+    
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=False)
+        cumulative_probs = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = cumulative_probs <= (1 - top_p)
+        sorted_to_remove[..., -1] = False
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        logits = logits.masked_fill(to_remove, float("-inf"))
+    
+    return torch.multinomial(logits.softmax(dim=-1), num_samples=1).squeeze(1)
+
+
+class FastDecoder:
+    """
+    Drop-in for MusicgenForConditionalGeneration.generate() on the hot path
+    
+    Mirrors generate()'s sampling: text (and optional audio prompt)
+    conditioning, classifier-free guidance, the codebook delay pattern,
+    temperature/top-k/top-p warping and streamer callbacks. The KV cache is
+    allocated once per generation instead of being re-concatenated every
+    step. A compiled step attends over the whole buffer, allocated at a
+    bucketed length so requests of similar duration reuse one compiled
+    graph; the eager step attends over the written prefix only.
+    
+    Other runtimes subclass this and override _cross_attention_cache and
+    _run_step, reusing the sampling loop.
+    """
+    
+    def __init__(self, musicgen_model, compile_step: bool = True, bucket_steps: int = 256):
+        self._init_geometry(musicgen_model, bucket_steps)
+        self.step = StaticCacheDecoder(musicgen_model).eval()
+        self.dtype = self.step.embed_tokens[0].weight.dtype
+        self.compiled_step = None
+        
+        if compile_step and hasattr(torch, "compile"):
+            try:
+                self.compiled_step = torch.compile(self.step, dynamic=False)
+            except Exception as e:
+                logger.warning(f"Decoder step compilation unavailable, using eager step: {e}")
+    
+    def _init_geometry(self, musicgen_model, bucket_steps: int):
+        decoder_config = musicgen_model.decoder.config
+        
+        self.model = musicgen_model
+        self.bucket_steps = bucket_steps
+        self.num_codebooks = decoder_config.num_codebooks
+        self.num_layers = decoder_config.num_hidden_layers
+        self.num_heads = decoder_config.num_attention_heads
+        self.head_dim = decoder_config.hidden_size // self.num_heads
+        self.max_positions = decoder_config.max_position_embeddings
+        self.dtype = torch.float32
+    
+    @property
+    def uses_full_cache(self) -> bool:
+        """
+        Whether the step needs the whole buffer (fixed shapes) rather than the written prefix
+        """
+        return self.compiled_step is not None
+    
+    def supports(self, inputs: Dict, max_new_tokens: int) -> bool:
+        """
+        Check this request fits the static decoder (mono models, positions in range)
+        """
+        if self.model.decoder.config.audio_channels != 1:
+            return False
+        
+        prompt_steps = 1
+        if "input_values" in inputs:
+            hop_length = int(np.prod(self.model.config.audio_encoder.upsampling_ratios))
+            prompt_steps += -(-inputs["input_values"].shape[-1] // hop_length)
+        
+        return prompt_steps + max_new_tokens <= self.max_positions
+    
+    def _run_step(self, *args):
+        if self.compiled_step is not None:
+            try:
+                return self.compiled_step(*args)
+            except Exception as e:
+                # Compilation happens on the first call, before anything is written
+                logger.warning(f"Compiled decoder step failed, falling back to eager: {e}")
+                self.compiled_step = None
+        
+        return self.step(*args)
+    
+    def _encoder_states(self, inputs: Dict, use_guidance: bool):
+        """
+        Text encoder states and mask, with the unconditional half for CFG
+        """
+        attention_mask = inputs.get("attention_mask")
+        
+        if inputs.get("encoder_outputs") is not None:
+            # Already includes the guidance half (see _text_conditioning)
+            encoder_hidden_states = inputs["encoder_outputs"].last_hidden_state
+        else:
+            encoder_hidden_states = self.model.text_encoder(
+                input_ids=inputs["input_ids"],
+                attention_mask=attention_mask
+            ).last_hidden_state
+            if use_guidance:
+                encoder_hidden_states = torch.cat(
+                    [encoder_hidden_states, torch.zeros_like(encoder_hidden_states)], dim=0
+                )
+                attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)], dim=0)
+        
+        return encoder_hidden_states, attention_mask
+    
+    def _cross_attention_cache(self, encoder_hidden_states: torch.Tensor, attention_mask: Optional[torch.Tensor]):
+        """
+        Cross-attention keys and values of the (projected, masked) text states
+        """
+        if (
+            self.model.text_encoder.config.hidden_size != self.model.decoder.config.hidden_size
+            and self.model.decoder.config.cross_attention_hidden_size is None
+        ):
+            encoder_hidden_states = self.model.enc_to_dec_proj(encoder_hidden_states)
+        
+        if attention_mask is not None:
+            encoder_hidden_states = encoder_hidden_states * attention_mask[..., None]
+        
+        return self.step.cross_attention_cache(encoder_hidden_states.to(self.dtype))
+    
+    @torch.no_grad()
+    def generate(
+        self,
+        inputs: Dict,
+        max_new_tokens: int,
+        do_sample: Optional[bool] = None,
+        temperature: Optional[float] = None,
+        top_k: Optional[int] = None,
+        top_p: Optional[float] = None,
+        streamer=None
+    ) -> torch.Tensor:
+        """
+        Generate audio values of shape (batch, 1, samples), as generate() returns
+        
+        Sampling arguments left as None fall back to the model's generation
+        config, as they do in generate().
+        """
+        generation_config = self.model.generation_config
+        do_sample = generation_config.do_sample if do_sample is None else do_sample
+        temperature = generation_config.temperature if temperature is None else temperature
+        top_k = generation_config.top_k if top_k is None else top_k
+        top_p = generation_config.top_p if top_p is None else top_p
+        guidance_scale = generation_config.guidance_scale
+        use_guidance = guidance_scale is not None and guidance_scale > 1
+        num_codebooks = self.num_codebooks
+        batch_size = inputs["input_ids"].shape[0]
+        dtype = self.dtype
+        
+        encoder_hidden_states, attention_mask = self._encoder_states(inputs, use_guidance)
+        
+        # Decoder prompt: start token, then EnCodec codes of any audio prompt
+        decoder_input_ids = torch.full(
+            (batch_size * num_codebooks, 1),
+            generation_config.decoder_start_token_id,
+            dtype=torch.long,
+            device=encoder_hidden_states.device
+        )
+        audio_scales = [None] * batch_size
+        
+        if "input_values" in inputs:
+            encoded = self.model.audio_encoder.encode(
+                input_values=inputs["input_values"],
+                padding_mask=inputs.get("padding_mask")
+            )
+            audio_scales = encoded.audio_scales
+            decoder_input_ids = torch.cat(
+                [decoder_input_ids, encoded.audio_codes[0].reshape(batch_size * num_codebooks, -1)], dim=-1
+            )
+        
+        max_length = decoder_input_ids.shape[-1] + max_new_tokens
+        input_ids, pattern_mask = self.model.decoder.build_delay_pattern_mask(
+            decoder_input_ids,
+            pad_token_id=generation_config.decoder_start_token_id,
+            max_length=max_length
+        )
+        prompt_length = input_ids.shape[-1]
+        
+        if streamer is not None:
+            streamer.put(input_ids.cpu())
+        
+        # Static buffers, rounded up so similar lengths share a compiled step
+        cache_length = min(-(-max_length // self.bucket_steps) * self.bucket_steps, self.max_positions)
+        rows = encoder_hidden_states.shape[0]
+        
+        key_cache = torch.zeros(
+            (self.num_layers, rows, self.num_heads, cache_length, self.head_dim),
+            dtype=dtype,
+            device=encoder_hidden_states.device
+        )
+        value_cache = torch.zeros_like(key_cache)
+        cross_keys, cross_values = self._cross_attention_cache(encoder_hidden_states, attention_mask)
+        
+        min_value = torch.finfo(dtype).min
+        if attention_mask is not None:
+            cross_mask = (1.0 - attention_mask[:, None, None, :].to(dtype)) * min_value
+        else:
+            cross_mask = torch.zeros(
+                (rows, 1, 1, encoder_hidden_states.shape[1]),
+                dtype=dtype,
+                device=encoder_hidden_states.device
+            )
+        cache_positions = torch.arange(cache_length, device=encoder_hidden_states.device)
+        
+        tokens = pattern_mask.clone()
+        
+        for step in range(max_length - 1):
+            current = tokens[:, step].reshape(batch_size, num_codebooks)
+            if use_guidance:
+                current = current.repeat(2, 1)
+            
+            position = cache_positions[step:step + 1]
+            
+            if self.uses_full_cache:
+                # Fixed shapes: the whole buffer, with unwritten slots masked
+                cached_keys = key_cache
+                cached_values = value_cache
+                self_mask = torch.zeros(cache_length, dtype=dtype, device=key_cache.device)
+                self_mask.masked_fill_(cache_positions >= step, min_value)
+            else:
+                cached_keys = key_cache[..., :step, :]
+                cached_values = value_cache[..., :step, :]
+                self_mask = torch.zeros(step, dtype=dtype, device=key_cache.device)
+            
+            logits, new_keys, new_values = self._run_step(
+                current, position, cached_keys, cached_values, cross_keys, cross_values, self_mask, cross_mask
+            )
+            key_cache.index_copy_(3, position, new_keys)
+            value_cache.index_copy_(3, position, new_values)
+            
+            # Positions inside the prompt are forced, not sampled
+            if step + 1 < prompt_length:
+                continue
+            
+            logits = logits.float()
+            if use_guidance:
+                conditional, unconditional = logits.split(batch_size, dim=0)
+                logits = unconditional + (conditional - unconditional) * guidance_scale
+            
+            next_tokens = _sample(
+                logits.reshape(batch_size * num_codebooks, -1), do_sample, temperature, top_k, top_p
+            )
+            
+            # Keep the delay pattern's padding where it applies
+            pattern_column = pattern_mask[:, step + 1]
+            tokens[:, step + 1] = torch.where(pattern_column == -1, next_tokens, pattern_column)
+            
+            if streamer is not None:
+                streamer.put(next_tokens.cpu())
+        
+        if streamer is not None:
+            streamer.end()
+        
+        # Undo the delay pattern and decode the codes to audio
+        output_ids = tokens[tokens != generation_config.pad_token_id].reshape(batch_size, num_codebooks, -1)
+        
+        return self.model.audio_encoder.decode(output_ids[None], audio_scales=audio_scales).audio_values
@@ -0,0 +1,71 @@
+"""
+Generation Cache - Content-addressed cache of seeded generation results
+"""
+import hashlib
+import json
+import logging
+from typing import Dict, Optional
+from services.redis_client import get_redis
+from utils.config import is_result_cache_enabled, get_result_cache_ttl
+
+logger = logging.getLogger(__name__)
+
+
+def generation_cache_key(
+    prompt: str,
+    model: str,
+    duration: int,
+    temperature: float,
+    top_k: int,
+    top_p: float,
+    seed: int
+) -> str:
+    """
+    Build the cache key for a seeded generation request
+    
+    Only seeded requests are deterministic, so only they are cacheable.
+    """
+    params = {
+        "prompt": " ".join(prompt.split()),
+        "model": model,
+        "duration": duration,
+        "temperature": float(temperature),
+        "top_k": top_k,
+        "top_p": float(top_p),
+        "seed": seed
+    }
+    digest = hashlib.sha256(json.dumps(params, sort_keys=True).encode("utf-8")).hexdigest()
+    return f"grammy:generation:{digest}"
+
+
+def get_cached_generation(cache_key: str) -> Optional[Dict]:
+    """
+    Get stored URLs for a previously generated identical request
+    """
+    if not is_result_cache_enabled():
+        return None
+    
+    try:
+        payload = get_redis().get(cache_key)
+    except Exception as e:
+        logger.warning(f"Generation cache lookup failed: {e}")
+        return None
+    
+    if payload is None:
+        return None
+    
+    logger.info(f"Generation cache hit: {cache_key}")
+    return json.loads(payload)
+
+
+def store_generation(cache_key: str, result: Dict):
+    """
+    Store the uploaded URLs of a generation result
+    """
+    if not is_result_cache_enabled():
+        return
+    
+    try:
+        get_redis().set(cache_key, json.dumps(result), ex=get_result_cache_ttl())
+    except Exception as e:
+        logger.warning(f"Generation cache store failed: {e}")
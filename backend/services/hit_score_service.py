@@ -110,6 +110,23 @@ def extract_audio_features(audio_path: str) -> Dict:
         
         y, sr = librosa.load(audio_path, sr=target_sr)
         
+        return extract_features_from_array(y, sr)
+    
+    except Exception as e:
+        logger.error(f"Feature extraction failed: {e}")
+        raise
+
+
+def extract_features_from_array(y: np.ndarray, sr: int) -> Dict:
+    """
+    Extract audio features from in-memory mono audio
+    """
+    try:
+        # In lightweight mode, use lower sample rate for faster processing
+        if is_lightweight_mode() and sr != 22050:
+            y = librosa.resample(y, orig_sr=sr, target_sr=22050)
+            sr = 22050
+        
         # Basic features
         duration = librosa.get_duration(y=y, sr=sr)
         
@@ -198,6 +215,27 @@ def calculate_production_quality(features: Dict) -> float:
     return min(100, max(0, score))
 
 
+def score_generation_candidate(audio_array: np.ndarray, sample_rate: int) -> float:
+    """
+    Cheap quality score (0-100) for ranking candidates generated from one prompt
+    
+    Candidates share prompt, duration and metadata, so only the
+    feature-driven categories can tell them apart; they are weighted as in
+    the Grammy Meter overall score.
+    """
+    features = extract_features_from_array(audio_array.astype(np.float32), sample_rate)
+    
+    weighted_scores = [
+        (calculate_production_quality(features), 0.25),
+        (calculate_innovation(features), 0.15),
+        (calculate_emotional_impact(features), 0.20)
+    ]
+    
+    return sum(score * weight for score, weight in weighted_scores) / sum(
+        weight for _, weight in weighted_scores
+    )
+
+
 def calculate_commercial_appeal(features: Dict, metadata: Dict) -> float:
     """
     Score commercial/radio appeal (0-100)
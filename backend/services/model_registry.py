@@ -0,0 +1,127 @@
+"""
+Model Registry - Public model ids, MusicGen checkpoints and worker queues
+Kept free of torch imports so the API can validate requests cheaply
+"""
+import logging
+import math
+from typing import Dict, List, Optional
+from utils.config import get_model_size, is_model_queue_routing_enabled
+
+logger = logging.getLogger(__name__)
+
+# Queue consumed by generation workers when routing per model is disabled
+GENERATION_QUEUE = "song_generation"
+
+# Public model ids accepted by the API
+MODEL_REGISTRY = {
+    "musicgen-small": {
+        "name": "MusicGen Small",
+        "description": "Fast generation, good quality",
+        "checkpoint": "facebook/musicgen-small",
+        "size": "small",
+        "max_duration": 30,
+        "speed": "fast"
+    },
+    "musicgen-medium": {
+        "name": "MusicGen Medium",
+        "description": "Balanced quality and speed",
+        "checkpoint": "facebook/musicgen-medium",
+        "size": "medium",
+        "max_duration": 60,
+        "speed": "medium"
+    },
+    "musicgen-large": {
+        "name": "MusicGen Large",
+        "description": "Highest quality, slower",
+        "checkpoint": "facebook/musicgen-large",
+        "size": "large",
+        "max_duration": 180,
+        "speed": "slow"
+    }
+}
+
+
+def resolve_model_id(model: Optional[str] = None) -> str:
+    """
+    Resolve a model id, size ('small') or checkpoint name to a registry id
+    
+    Raises:
+        ValueError: If the model is not in the registry
+    """
+    if model is None:
+        model = get_model_size()
+    
+    for model_id, info in MODEL_REGISTRY.items():
+        if model in (model_id, info["size"], info["checkpoint"]):
+            return model_id
+    
+    raise ValueError(
+        f"Unknown model '{model}'. Available models: {', '.join(MODEL_REGISTRY)}"
+    )
+
+
+def get_checkpoint_name(model: Optional[str] = None) -> str:
+    """
+    Get the Hugging Face checkpoint for a model
+    """
+    return MODEL_REGISTRY[resolve_model_id(model)]["checkpoint"]
+
+
+def get_generation_queue(model: Optional[str] = None) -> str:
+    """
+    Get the Celery queue that generation jobs for a model are routed to
+    
+    With MODEL_QUEUE_ROUTING enabled each size has its own queue
+    (e.g. song_generation.small), so a worker consuming one queue only ever
+    loads one model.
+    """
+    if not is_model_queue_routing_enabled():
+        return GENERATION_QUEUE
+    
+    return f"{GENERATION_QUEUE}.{MODEL_REGISTRY[resolve_model_id(model)]['size']}"
+
+
+def get_batch_collector_prefix(model: Optional[str] = None) -> str:
+    """
+    Prefix of the Redis lists collecting batchable jobs for a model
+    (see workers.song_tasks.submit_song_generation)
+    """
+    return f"grammy:song_batch:{resolve_model_id(model)}:"
+
+
+def tokens_for_duration(duration: float, frame_rate: int, num_codebooks: int) -> int:
+    """
+    Number of decoder steps that produce exactly the requested duration
+    
+    The codebook delay pattern offsets codebook k by k steps, so the last
+    num_codebooks - 1 steps are needed to complete the final frames.
+    """
+    return int(math.ceil(duration * frame_rate)) + num_codebooks - 1
+
+
+def get_queue_model_sizes(queue_names: List[str]) -> List[str]:
+    """
+    Model sizes served by per-model generation queues in queue_names
+    """
+    sizes = []
+    for queue_name in queue_names:
+        prefix, _, size = queue_name.partition(".")
+        if prefix == GENERATION_QUEUE and size:
+            sizes.append(size)
+    return sizes
+
+
+def list_models() -> List[Dict]:
+    """
+    List available models for the API
+    """
+    return [
+        {
+            "id": model_id,
+            "name": info["name"],
+            "description": info["description"],
+            "max_duration": info["max_duration"],
+            "speed": info["speed"]
+        }
+        for model_id, info in MODEL_REGISTRY.items()
+    ]
@@ -3,114 +3,975 @@ MusicGen Service - AI music generation using Meta's MusicGen
 Optimized for ARM architecture with lightweight mode support
 """
 import torch
+import transformers
 from transformers import AutoProcessor, MusicgenForConditionalGeneration
+from transformers.generation.streamers import BaseStreamer
+from transformers.modeling_outputs import BaseModelOutput
 import scipy.io.wavfile as wavfile
 import numpy as np
-from typing import Dict, Optional
+from collections import OrderedDict
+from typing import Callable, Dict, List, Optional, Union
+import contextlib
+import gc
+import hashlib
+import io
 import tempfile
 import os
+import time
 import logging
-from pydub import AudioSegment
 import librosa
+import soundfile as sf
+from services.encoding_service import AUDIO_FORMATS, encode_audio
+from services.eta_service import record_decode_rate
+from services.fast_decode import FastDecoder
+from services.hit_score_service import score_generation_candidate
+from services.onnx_backend import OnnxMusicgenModel, load_onnx_model
+from services.model_registry import get_checkpoint_name, tokens_for_duration
+from services.redis_client import get_redis
+from services.stem_separation import separate_stems
+from services.worker_stats import publish_model_cache_stats
 from utils.config import (
     is_lightweight_mode,
-    get_model_size,
     get_model_precision,
-    get_audio_buffer_size
+    get_model_backend,
+    get_model_cache_dir,
+    get_model_share_mode,
+    get_model_cache_budget_mb,
+    get_preload_model_sizes,
+    get_prompt_cache_size,
+    get_prompt_cache_ttl,
+    is_prompt_cache_redis_enabled,
+    is_model_artifact_cache_enabled,
+    get_generation_batch_size,
+    get_stream_chunk_seconds,
+    get_generation_window_seconds,
+    get_generation_context_seconds,
+    get_max_return_sequences,
+    get_output_audio_format,
+    is_fast_decode_enabled,
+    is_decode_compile_enabled,
+    get_fast_decode_bucket_steps,
+    get_torch_num_threads,
+    get_torch_interop_threads,
+    is_cpu_pinning_enabled,
+    get_worker_cpu_set
 )
 
 logger = logging.getLogger(__name__)
 
-# Constants for model optimization
-# Retains 80% of tokens in lightweight mode (20% reduction) for faster generation
-LIGHTWEIGHT_TOKEN_REDUCTION_FACTOR = 0.8
+# Prompts are only batched together when the longest duration in the group is
+# within this ratio of the shortest, limiting tokens decoded and then discarded
+BATCH_DURATION_TOLERANCE = 1.25
 
-# Model cache
-_models = {}
+# Decoder steps run by the boot-time warmup generation
+WARMUP_TOKENS = 10
 
+# Crossfade between a window's re-decoded context and the audio it continues
+WINDOW_CROSSFADE_SECONDS = 0.5
 
-def get_model_name(size: str = None) -> str:
+# Model cache, ordered from least to most recently used
+_models = OrderedDict()
+
+# Model cache counters, reported in logs and by get_model_cache_stats()
+# (published to Redis for the API, see services.worker_stats)
+_model_cache_stats = {"hits": 0, "misses": 0, "evictions": 0}
+
+# Text encoder hidden states keyed by (model, normalized prompt), LRU ordered
+_prompt_embeddings = OrderedDict()
+
+# Measured single-track decoder steps per second by model name (EWMA)
+_decode_rates: Dict[str, float] = {}
+
+
+class AudioChunkStreamer(BaseStreamer):
     """
-    Get appropriate model name based on size preference
+    Streamer that decodes the EnCodec token stream in windows during generate()
+    
+    Every play_steps decoder steps the tokens generated so far are decoded to
+    audio and the newly finalized samples are passed to on_chunk as WAV bytes.
+    A stride of samples is held back from each window because the last frames
+    change once the following tokens are known.
     """
-    if size is None:
-        size = get_model_size()
     
-    model_map = {
-        'small': 'facebook/musicgen-small',
-        'medium': 'facebook/musicgen-medium',
-        'large': 'facebook/musicgen-large'
-    }
-    return model_map.get(size, 'facebook/musicgen-medium')
+    def __init__(
+        self,
+        model,
+        total_steps: int,
+        on_chunk: Callable[[int, bytes, float], None],
+        play_steps: int
+    ):
+        self.decoder = model.decoder
+        self.audio_encoder = model.audio_encoder
+        self.generation_config = model.generation_config
+        self.sample_rate = model.config.audio_encoder.sampling_rate
+        self.total_steps = total_steps
+        self.on_chunk = on_chunk
+        self.play_steps = play_steps
+        
+        hop_length = int(np.prod(self.audio_encoder.config.upsampling_ratios))
+        self.stride = max(1, hop_length * (play_steps - self.decoder.num_codebooks) // 6)
+        
+        self.token_cache = None
+        self.samples_emitted = 0
+        self.chunk_index = 0
+    
+    def _decode_tokens(self) -> np.ndarray:
+        """
+        Undo the codebook delay pattern and decode cached tokens to audio
+        """
+        _, delay_pattern_mask = self.decoder.build_delay_pattern_mask(
+            self.token_cache[:, :1],
+            pad_token_id=self.generation_config.decoder_start_token_id,
+            max_length=self.token_cache.shape[-1],
+        )
+        input_ids = self.decoder.apply_delay_pattern_mask(self.token_cache, delay_pattern_mask)
+        input_ids = input_ids[input_ids != self.generation_config.pad_token_id].reshape(
+            1, 1, self.decoder.num_codebooks, -1
+        )
+        
+        output_values = self.audio_encoder.decode(
+            input_ids.to(self.audio_encoder.device), audio_scales=[None]
+        )
+        return output_values.audio_values[0, 0].cpu().float().numpy()
+    
+    def _emit(self, audio_chunk: np.ndarray, progress: float):
+        if len(audio_chunk) == 0:
+            return
+        
+        self.on_chunk(self.chunk_index, _encode_wav(audio_chunk, self.sample_rate), progress)
+        self.samples_emitted += len(audio_chunk)
+        self.chunk_index += 1
+    
+    def put(self, value):
+        if value.shape[0] // self.decoder.num_codebooks > 1:
+            raise ValueError("AudioChunkStreamer only supports batch size 1")
+        
+        # First call receives the decoder start tokens, later calls one token per codebook
+        if self.token_cache is None:
+            self.token_cache = value
+        else:
+            self.token_cache = torch.cat([self.token_cache, value[:, None]], dim=-1)
+        
+        steps = self.token_cache.shape[-1]
+        if steps % self.play_steps == 0 and steps > self.decoder.num_codebooks:
+            audio_values = self._decode_tokens()
+            self._emit(
+                audio_values[self.samples_emitted:-self.stride],
+                min(1.0, steps / self.total_steps)
+            )
+    
+    def end(self):
+        if self.token_cache is not None and self.token_cache.shape[-1] > self.decoder.num_codebooks:
+            self._emit(self._decode_tokens()[self.samples_emitted:], 1.0)
+
+
+class _WindowChunkEmitter:
+    """
+    Emits windowed generation output (see _generate_windowed) as chunks
+    
+    Finalized samples are passed to on_chunk in chunk_seconds pieces as
+    each window completes, matching AudioChunkStreamer's callback.
+    """
+    
+    def __init__(
+        self,
+        on_chunk: Callable[[int, bytes, float], None],
+        sample_rate: int,
+        chunk_seconds: float,
+        duration: float
+    ):
+        self.on_chunk = on_chunk
+        self.sample_rate = sample_rate
+        self.chunk_samples = max(1, int(chunk_seconds * sample_rate))
+        self.total_samples = int(duration * sample_rate)
+        self.samples_emitted = 0
+        self.chunk_index = 0
+    
+    def __call__(self, output: np.ndarray, final_samples: int, done: bool):
+        while final_samples - self.samples_emitted >= self.chunk_samples or (
+            done and final_samples > self.samples_emitted
+        ):
+            end = min(self.samples_emitted + self.chunk_samples, final_samples)
+            self.on_chunk(
+                self.chunk_index,
+                _encode_wav(output[self.samples_emitted:end], self.sample_rate),
+                1.0 if done and end == final_samples else min(1.0, end / self.total_samples)
+            )
+            self.samples_emitted = end
+            self.chunk_index += 1
+
+
+def get_model_name(model: str = None) -> str:
+    """
+    Get Hugging Face model name for a model id, size or checkpoint name
+    Defaults to the configured model size
+    """
+    return get_checkpoint_name(model)
+
+
+def _model_artifact_path(model_name: str) -> str:
+    """
+    Path of the optimized model artifact for the current configuration
+    
+    The key covers everything that changes the converted weights or their
+    pickled layout: model, precision, lightweight mode and library versions.
+    """
+    key = "-".join([
+        model_name.replace("/", "--"),
+        get_model_precision(),
+        "lightweight" if is_lightweight_mode() else "standard",
+        f"torch{torch.__version__}",
+        f"transformers{transformers.__version__}",
+    ])
+    return os.path.join(get_model_cache_dir(), f"{key}.pt")
+
+
+def _load_model_artifact(artifact_path: str, device: str):
+    """
+    Load a cached optimized model, memory-mapping weights on CPU
+    """
+    try:
+        model = torch.load(
+            artifact_path,
+            map_location=device,
+            mmap=(device == "cpu"),
+            weights_only=False
+        )
+        logger.info(f"Loaded optimized model artifact: {artifact_path}")
+        return model
+    except Exception as e:
+        logger.warning(f"Model artifact unreadable, rebuilding: {e}")
+        # Another worker process may already have removed it
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(artifact_path)
+        return None
+
+
+def _save_model_artifact(model, artifact_path: str):
+    """
+    Serialize an optimized model to the artifact cache
+    """
+    try:
+        os.makedirs(os.path.dirname(artifact_path), exist_ok=True)
+        
+        # Write to a temporary file first so concurrent workers never read a partial artifact
+        temp_path = f"{artifact_path}.{os.getpid()}.tmp"
+        torch.save(model, temp_path)
+        os.replace(temp_path, artifact_path)
+        
+        logger.info(f"Saved optimized model artifact: {artifact_path}")
+    except Exception as e:
+        logger.warning(f"Failed to save model artifact: {e}")
+
+
+def _build_optimized_model(model_name: str, device: str):
+    """
+    Load pretrained MusicGen weights and apply mode-specific optimizations
+    """
+    model = MusicgenForConditionalGeneration.from_pretrained(model_name)
+    
+    # Apply optimizations based on mode
+    precision = get_model_precision()
+    
+    if is_lightweight_mode():
+        logger.info("Applying lightweight mode optimizations...")
+        
+        # Quantize model for ARM (INT8) - 75% memory reduction
+        if precision == 'int8' and device == "cpu":
+            try:
+                model = torch.quantization.quantize_dynamic(
+                    model, {torch.nn.Linear}, dtype=torch.qint8
+                )
+                logger.info("Model quantized to INT8")
+            except (RuntimeError, AttributeError) as e:
+                logger.warning(f"INT8 quantization failed, using FP32: {e}")
+            except Exception as e:
+                logger.error(f"Unexpected error during quantization: {e}", exc_info=True)
+                raise
+        elif precision == 'float16':
+            model = model.half()
+            logger.info("Model converted to FP16")
+    
+    model = model.to(device)
+    
+    # Enable inference mode optimizations
+    model.eval()
+    
+    return model
+
+
+def _load_torch_model(model_name: str):
+    """
+    Load the optimized PyTorch model, via the on-disk artifact cache when enabled
+    """
+    artifact_path = _model_artifact_path(model_name)
+    
+    # Make room up front when the artifact size tells us what is coming
+    if os.path.exists(artifact_path):
+        _evict_models(reserve_mb=os.path.getsize(artifact_path) / (1024 * 1024))
+    
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    
+    model = None
+    
+    # mmap sharing needs the artifact on disk, so it implies the artifact cache
+    share_via_mmap = get_model_share_mode() == "mmap" and device == "cpu"
+    use_artifacts = is_model_artifact_cache_enabled() or share_via_mmap
+    
+    if use_artifacts and os.path.exists(artifact_path):
+        model = _load_model_artifact(artifact_path, device)
+    
+    if model is None:
+        model = _build_optimized_model(model_name, device)
+        
+        if use_artifacts:
+            _save_model_artifact(model, artifact_path)
+            
+            # Swap the private copy for the mapped artifact so this process
+            # shares page-cache weights with every other worker too
+            if share_via_mmap and os.path.exists(artifact_path):
+                model = _load_model_artifact(artifact_path, device) or model
+    
+    return device, model
 
 
 def get_model(model_name: str = None):
     """
     Load and cache MusicGen model with ARM optimization
+    
+    The optimized model is also kept in an on-disk artifact cache so worker
+    restarts (e.g. after worker_max_tasks_per_child) skip conversion.
     """
     if model_name is None:
         model_name = get_model_name()
     
-    if model_name not in _models:
+    if model_name in _models:
+        _model_cache_stats["hits"] += 1
+        _models.move_to_end(model_name)
+    else:
+        _model_cache_stats["misses"] += 1
         logger.info(f"Loading model: {model_name}")
         
         processor = AutoProcessor.from_pretrained(model_name)
-        model = MusicgenForConditionalGeneration.from_pretrained(model_name)
         
-        # Apply optimizations based on mode
-        precision = get_model_precision()
-        device = "cuda" if torch.cuda.is_available() else "cpu"
+        if get_model_backend() == "onnx":
+            # ONNX Runtime keeps its own cache of exported graphs
+            device = "cpu"
+            model = load_onnx_model(model_name)
+        else:
+            device, model = _load_torch_model(model_name)
         
-        if is_lightweight_mode():
-            logger.info("Applying lightweight mode optimizations...")
-            
-            # Quantize model for ARM (INT8) - 75% memory reduction
-            if precision == 'int8' and device == "cpu":
-                try:
-                    model = torch.quantization.quantize_dynamic(
-                        model, {torch.nn.Linear}, dtype=torch.qint8
-                    )
-                    logger.info("Model quantized to INT8")
-                except (RuntimeError, AttributeError) as e:
-                    logger.warning(f"INT8 quantization failed, using FP32: {e}")
-                except Exception as e:
-                    logger.error(f"Unexpected error during quantization: {e}", exc_info=True)
-                    raise
-            elif precision == 'float16':
-                model = model.half()
-                logger.info("Model converted to FP16")
-        
-        model = model.to(device)
-        
-        # Enable inference mode optimizations
-        model.eval()
-        
-        # Apply JIT optimization only in standard mode
-        if hasattr(torch, 'jit') and not is_lightweight_mode():
-            try:
-                model = torch.jit.optimize_for_inference(model)
-                logger.info("JIT optimization applied")
-            except Exception as e:
-                logger.warning(f"JIT optimization failed, using standard model: {e}")
+        _models[model_name] = {
+            "name": model_name,
+            "processor": processor,
+            "model": model,
+            "device": device,
+            "size_mb": _model_size_mb(model)
+        }
         
-        _models[model_name] = {"processor": processor, "model": model, "device": device}
+        logger.info(
+            f"Model loaded on {device} (Lightweight: {is_lightweight_mode()}, "
+            f"{_models[model_name]['size_mb']:.0f} MB)"
+        )
         
-        logger.info(f"Model loaded on {device} (Lightweight: {is_lightweight_mode()})")
+        _evict_models(keep=model_name)
+        logger.info(f"Model cache: {get_model_cache_stats()}")
+    
+    # Reported by the API's /health route
+    publish_model_cache_stats(get_model_cache_stats())
     
     return _models[model_name]
 
 
+def _model_size_mb(model) -> float:
+    """
+    Approximate resident size of a model's weights in MB
+    """
+    if isinstance(model, OnnxMusicgenModel):
+        return model.size_mb
+    
+    total_bytes = 0
+    
+    # state_dict covers parameters, buffers and INT8 packed weights
+    for value in model.state_dict().values():
+        tensors = value if isinstance(value, tuple) else (value,)
+        for tensor in tensors:
+            if isinstance(tensor, torch.Tensor):
+                total_bytes += tensor.numel() * tensor.element_size()
+    
+    return total_bytes / (1024 * 1024)
+
+
+def _evict_models(reserve_mb: float = 0.0, keep: str = None):
+    """
+    Evict least recently used models until the cache fits the memory budget
+    """
+    budget_mb = get_model_cache_budget_mb()
+    if budget_mb <= 0:
+        return
+    
+    evicted = False
+    for model_name in list(_models.keys()):
+        cached_mb = sum(entry["size_mb"] for entry in _models.values())
+        if cached_mb + reserve_mb <= budget_mb:
+            break
+        if model_name == keep:
+            continue
+        
+        logger.info(f"Evicting model {model_name} (cache {cached_mb:.0f} MB, budget {budget_mb:.0f} MB)")
+        del _models[model_name]
+        _model_cache_stats["evictions"] += 1
+        evicted = True
+    
+    if evicted:
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+def unload_model(model_name: str) -> bool:
+    """
+    Remove a model from the in-process cache and release its memory
+    
+    Returns:
+        True if the model was loaded
+    """
+    if _models.pop(model_name, None) is None:
+        return False
+    
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    
+    logger.info(f"Unloaded model: {model_name}")
+    
+    return True
+
+
+def get_model_cache_stats() -> Dict:
+    """
+    Get model cache counters and current memory usage
+    """
+    return {
+        **_model_cache_stats,
+        "loaded_models": list(_models.keys()),
+        "cached_mb": round(sum(entry["size_mb"] for entry in _models.values()), 1),
+        "budget_mb": get_model_cache_budget_mb()
+    }
+
+
+def configure_cpu_threads(worker_index: int = 0):
+    """
+    Size torch's thread pools to this worker's share of the CPUs
+    
+    Called in each prefork child before any inference. With CPU_AFFINITY
+    enabled the process is also pinned to its own block of CPUs, so
+    children never migrate onto each other's cores.
+    """
+    threads = get_torch_num_threads()
+    torch.set_num_threads(threads)
+    
+    try:
+        torch.set_num_interop_threads(get_torch_interop_threads())
+    except RuntimeError as e:
+        # Only settable before the inter-op pool has started
+        logger.warning(f"Could not set inter-op threads: {e}")
+    
+    cpus = None
+    if is_cpu_pinning_enabled() and hasattr(os, "sched_setaffinity"):
+        cpus = get_worker_cpu_set(worker_index)
+        os.sched_setaffinity(0, cpus)
+    
+    logger.info(
+        f"Worker {worker_index}: {threads} intra-op threads, "
+        f"{torch.get_num_interop_threads()} inter-op threads, CPUs {cpus or 'unpinned'}"
+    )
+
+
+def get_preload_model_names() -> List[str]:
+    """
+    Model names a generation worker loads at boot (PRELOAD_MODELS)
+    """
+    return [get_model_name(size) for size in get_preload_model_sizes()]
+
+
+def warmup_model(model_name: str):
+    """
+    Run a tiny generation so kernels, allocators and caches are initialized
+    before the first real request
+    """
+    start_time = time.time()
+    
+    model_data = get_model(model_name)
+    
+    inputs = model_data["processor"](
+        text=["warmup"],
+        padding=True,
+        return_tensors="pt",
+    ).to(model_data["device"])
+    
+    # Not timed: a few first-call tokens would skew the measured decode rates
+    _decode(model_data, inputs, max_new_tokens=WARMUP_TOKENS, do_sample=True)
+    
+    logger.info(f"Model {model_name} warmed up in {time.time() - start_time:.1f}s")
+
+
+def preload_shared_models(model_names: List[str] = None):
+    """
+    Load models in the Celery parent process so prefork children share them
+    
+    Children forked after this point inherit the loaded weights as
+    copy-on-write pages, so N children hold one copy of the model instead
+    of N. Loading and quantizing run parallel ATen ops, and the OpenMP pool
+    they would start is not fork-safe (children can hang on their first
+    parallel op), so the parent loads single-threaded; children size their
+    own pools in configure_cpu_threads.
+    """
+    if get_model_backend() == "onnx":
+        # ONNX Runtime sessions start their thread pools when created
+        logger.warning("MODEL_SHARE_MODE=fork is not supported by the onnx backend; workers load their own models")
+        return
+    
+    if model_names is None:
+        model_names = get_preload_model_names()
+    
+    torch.set_num_threads(1)
+    
+    for model_name in model_names:
+        get_model(model_name)
+    
+    # Move loaded objects out of the GC's tracked generations so collections
+    # in the children do not write to (and un-share) their pages
+    gc.freeze()
+    
+    logger.info(f"Preloaded {len(model_names)} model(s) for sharing across worker processes")
+
+
+def _normalize_prompt(prompt: str) -> str:
+    """
+    Normalize prompt text so trivially different submissions share a cache entry
+    """
+    return " ".join(prompt.split())
+
+
+def _prompt_cache_key(model_name: str, prompt: str) -> str:
+    # Workers sharing Redis may run other backends or precisions, whose text
+    # encoders produce embeddings of a different dtype
+    variant = f"{get_model_backend()}:{get_model_precision()}:{is_lightweight_mode()}"
+    digest = hashlib.sha256(f"{model_name}:{variant}:{prompt}".encode("utf-8")).hexdigest()
+    return f"grammy:prompt_emb:{digest}"
+
+
+def _get_cached_embedding(cache_key: str) -> Optional[torch.Tensor]:
+    """
+    Look up a prompt embedding in the in-process LRU, then in Redis
+    """
+    if cache_key in _prompt_embeddings:
+        _prompt_embeddings.move_to_end(cache_key)
+        return _prompt_embeddings[cache_key]
+    
+    if not is_prompt_cache_redis_enabled():
+        return None
+    
+    try:
+        payload = get_redis().get(cache_key)
+    except Exception as e:
+        logger.warning(f"Prompt embedding cache lookup failed: {e}")
+        return None
+    
+    if payload is None:
+        return None
+    
+    embedding = torch.from_numpy(np.load(io.BytesIO(payload), allow_pickle=False))
+    _store_local_embedding(cache_key, embedding)
+    return embedding
+
+
+def _store_local_embedding(cache_key: str, embedding: torch.Tensor):
+    max_entries = get_prompt_cache_size()
+    if max_entries <= 0:
+        return
+    
+    _prompt_embeddings[cache_key] = embedding
+    _prompt_embeddings.move_to_end(cache_key)
+    while len(_prompt_embeddings) > max_entries:
+        _prompt_embeddings.popitem(last=False)
+
+
+def _store_embedding(cache_key: str, embedding: torch.Tensor):
+    """
+    Store a prompt embedding in the in-process LRU and optionally in Redis
+    """
+    _store_local_embedding(cache_key, embedding)
+    
+    if not is_prompt_cache_redis_enabled():
+        return
+    
+    try:
+        buffer = io.BytesIO()
+        np.save(buffer, embedding.numpy(), allow_pickle=False)
+        get_redis().set(cache_key, buffer.getvalue(), ex=get_prompt_cache_ttl())
+    except Exception as e:
+        logger.warning(f"Prompt embedding cache store failed: {e}")
+
+
+def _text_conditioning(model_data: Dict, prompts: List[str], num_repeats: int = 1) -> Dict:
+    """
+    Build generate() kwargs for the prompts, reusing cached text encoder states
+    
+    MusicGen runs the T5 text encoder on every generate() call. Here each
+    prompt's encoder hidden states are looked up by (model, normalized
+    prompt) and only cache misses are encoded, in a single batch. The states
+    are passed to generate() as encoder_outputs with the classifier-free
+    guidance (unconditional) half appended, which is what generate() would
+    otherwise build itself.
+    
+    With num_repeats > 1 each prompt's states are repeated for that many
+    sequences instead of encoding the same prompt once per sequence.
+    """
+    musicgen_model = model_data["model"]
+    device = model_data["device"]
+    prompts = [_normalize_prompt(prompt) for prompt in prompts]
+    
+    inputs = model_data["processor"](
+        text=prompts,
+        padding=True,
+        return_tensors="pt",
+    ).to(device)
+    
+    use_cache = get_prompt_cache_size() > 0 or is_prompt_cache_redis_enabled()
+    if not use_cache and num_repeats == 1:
+        return inputs
+    
+    cache_keys = [_prompt_cache_key(model_data["name"], prompt) for prompt in prompts]
+    embeddings = [_get_cached_embedding(cache_key) if use_cache else None for cache_key in cache_keys]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    
+    if missing:
+        with torch.no_grad():
+            hidden_states = musicgen_model.text_encoder(
+                input_ids=inputs["input_ids"][missing],
+                attention_mask=inputs["attention_mask"][missing]
+            ).last_hidden_state
+        
+        for row, index in enumerate(missing):
+            # Drop padding so the entry is independent of the other prompts in this batch
+            length = int(inputs["attention_mask"][index].sum())
+            embeddings[index] = hidden_states[row, :length].cpu()
+            if use_cache:
+                _store_embedding(cache_keys[index], embeddings[index])
+    
+    logger.info(f"Prompt embeddings: {len(prompts) - len(missing)} cached, {len(missing)} encoded")
+    
+    # Re-pad cached states to a common length
+    max_length = max(embedding.shape[0] for embedding in embeddings)
+    hidden_size = embeddings[0].shape[-1]
+    last_hidden_state = torch.zeros(len(prompts), max_length, hidden_size, dtype=embeddings[0].dtype)
+    attention_mask = torch.zeros(len(prompts), max_length, dtype=torch.long)
+    for row, embedding in enumerate(embeddings):
+        last_hidden_state[row, :embedding.shape[0]] = embedding
+        attention_mask[row, :embedding.shape[0]] = 1
+    
+    input_ids = inputs["input_ids"]
+    if num_repeats > 1:
+        input_ids = input_ids.repeat_interleave(num_repeats, dim=0)
+        last_hidden_state = last_hidden_state.repeat_interleave(num_repeats, dim=0)
+        attention_mask = attention_mask.repeat_interleave(num_repeats, dim=0)
+    
+    guidance_scale = musicgen_model.generation_config.guidance_scale
+    if guidance_scale is not None and guidance_scale > 1:
+        last_hidden_state = torch.cat([last_hidden_state, torch.zeros_like(last_hidden_state)], dim=0)
+        attention_mask = torch.cat([attention_mask, torch.zeros_like(attention_mask)], dim=0)
+    
+    # input_ids only tells generate() the batch size once encoder_outputs is given
+    return {
+        "input_ids": input_ids,
+        "attention_mask": attention_mask.to(device),
+        "encoder_outputs": BaseModelOutput(last_hidden_state=last_hidden_state.to(device)),
+    }
+
+
+def _frame_rate(musicgen_model) -> int:
+    """
+    EnCodec frames (decoder steps per codebook) per second of audio
+    """
+    return musicgen_model.config.audio_encoder.frame_rate
+
+
+def _tokens_for_duration(duration: float, musicgen_model) -> int:
+    """
+    Number of decoder steps that produce exactly the requested duration
+    """
+    return tokens_for_duration(duration, _frame_rate(musicgen_model), musicgen_model.decoder.num_codebooks)
+
+
+def _generation_deadline(time_budget: Optional[float]) -> Optional[float]:
+    return time.time() + time_budget if time_budget else None
+
+
+def _budget_tokens(model_data: Dict, max_new_tokens: int, deadline: Optional[float]) -> int:
+    """
+    Cap decoder steps to what fits before the deadline at the measured rate
+    
+    generate() cannot be interrupted mid-decode (the codebook delay pattern
+    needs every step to finish the last frames), so the time budget is
+    enforced by planning how many steps to run instead.
+    """
+    rate = _decode_rates.get(model_data["name"])
+    if deadline is None or rate is None:
+        return max_new_tokens
+    
+    affordable = int((deadline - time.time()) * rate)
+    
+    # At least one complete frame, so there is always audio to return
+    return max(min(max_new_tokens, affordable), model_data["model"].decoder.num_codebooks)
+
+
+def _get_fast_decoder(model_data: Dict) -> FastDecoder:
+    """
+    Get the static-cache decoder for a loaded model, building it on first use
+    
+    It lives in the model cache entry rather than in the model artifact,
+    since compiled steps cannot be pickled.
+    """
+    if "fast_decoder" not in model_data:
+        model_data["fast_decoder"] = FastDecoder(
+            model_data["model"],
+            compile_step=is_decode_compile_enabled(),
+            bucket_steps=get_fast_decode_bucket_steps()
+        )
+        logger.info(f"Fast decoder built for {model_data['name']} (compiled: {is_decode_compile_enabled()})")
+    
+    return model_data["fast_decoder"]
+
+
+def _decode(model_data: Dict, inputs: Dict, max_new_tokens: int, **kwargs):
+    """
+    Decode audio with generate(), or the static KV-cache decoder when FAST_DECODE is on
+    
+    Requests the static decoder cannot serve (stereo models, lengths past
+    the positional table) fall back to generate().
+    """
+    # The ONNX backend's generate() already runs the static KV-cache loop
+    if is_fast_decode_enabled() and not isinstance(model_data["model"], OnnxMusicgenModel):
+        fast_decoder = _get_fast_decoder(model_data)
+        if fast_decoder.supports(inputs, max_new_tokens):
+            return fast_decoder.generate(inputs, max_new_tokens, **kwargs)
+    
+    with torch.no_grad():
+        return model_data["model"].generate(**inputs, max_new_tokens=max_new_tokens, **kwargs)
+
+
+def _run_generate(model_data: Dict, inputs: Dict, max_new_tokens: int, **kwargs):
+    """
+    Decode one track and record its decoder step rate, locally for time
+    budgets and in Redis for the ETA estimator
+    """
+    start_time = time.time()
+    
+    audio_values = _decode(model_data, inputs, max_new_tokens, **kwargs)
+    
+    rate = max_new_tokens / max(time.time() - start_time, 1e-3)
+    previous = _decode_rates.get(model_data["name"])
+    _decode_rates[model_data["name"]] = rate if previous is None else 0.7 * previous + 0.3 * rate
+    record_decode_rate(
+        model_data["name"],
+        rate,
+        _frame_rate(model_data["model"]),
+        model_data["model"].decoder.num_codebooks
+    )
+    
+    return audio_values
+
+
+def _log_if_truncated(audio_array: np.ndarray, sample_rate: int, duration: float):
+    generated_seconds = len(audio_array) / sample_rate
+    if generated_seconds < duration - 0.05:
+        logger.warning(
+            f"Generation time budget reached: returning {generated_seconds:.1f}s of {duration}s"
+        )
+
+
+def _normalize_audio(audio_array: np.ndarray) -> np.ndarray:
+    """
+    Peak-normalize audio to [-1, 1] as float32, leaving silence untouched
+    """
+    audio_array = np.asarray(audio_array, dtype=np.float32)
+    
+    peak = float(np.max(np.abs(audio_array))) if audio_array.size else 0.0
+    if peak > 0:
+        audio_array = audio_array * (1.0 / peak)
+    
+    return audio_array
+
+
+def _encode_audio(
+    audio_array: np.ndarray,
+    sample_rate: int,
+    audio_format: str = "wav",
+    normalize: bool = True
+) -> Dict:
+    """
+    Normalize generated audio and encode it in memory
+    
+    Args:
+        normalize: Peak-normalize first; without it the audio is only clipped,
+            keeping the level of chunks already streamed from it
+    
+    Returns:
+        Dictionary with the float32 "audio", its "sample_rate", the encoded
+        file "data" bytes, "format" and "content_type"
+    """
+    if normalize:
+        audio_array = _normalize_audio(audio_array)
+    else:
+        audio_array = np.clip(np.asarray(audio_array, dtype=np.float32), -1.0, 1.0)
+    
+    return {
+        "audio": audio_array,
+        "sample_rate": sample_rate,
+        "data": encode_audio(audio_array, sample_rate, audio_format),
+        "format": audio_format,
+        "content_type": AUDIO_FORMATS[audio_format]["content_type"]
+    }
+
+
+def _encode_wav(audio_array: np.ndarray, sample_rate: int) -> bytes:
+    """
+    Encode a chunk of audio as 16-bit WAV bytes without normalizing
+    """
+    buffer = io.BytesIO()
+    wavfile.write(buffer, sample_rate, (np.clip(audio_array, -1.0, 1.0) * 32767).astype(np.int16))
+    return buffer.getvalue()
+
+
+def _generate_windowed(
+    model_data: Dict,
+    text_inputs: Dict,
+    duration: float,
+    sampling: Dict,
+    initial_audio: Optional[np.ndarray] = None,
+    deadline: Optional[float] = None,
+    on_window: Optional[Callable[[np.ndarray, int, bool], None]] = None
+) -> np.ndarray:
+    """
+    Generate a long track as overlapping windows of sliding continuation
+    
+    Each window is conditioned on the text and on the last
+    GENERATION_CONTEXT_SECONDS of audio already produced, which MusicGen
+    encodes to EnCodec codes and continues from. Decoder attention therefore
+    never spans more than one window, so per-step cost and memory stay flat
+    regardless of track length. The re-decoded context is crossfaded into
+    the existing tail and the continuation written into a preallocated
+    output buffer.
+    
+    Args:
+        model_data: Loaded model components from get_model()
+        text_inputs: Text conditioning from _text_conditioning()
+        duration: Total duration in seconds
+        sampling: Sampling kwargs for generate()
+        initial_audio: Existing audio to continue from instead of starting fresh
+        deadline: time.time() by which to stop and return what was generated
+        on_window: Called after each window with (output buffer, samples that
+            are final, whether generation is done); the tail after the final
+            samples is still crossfaded by the next window
+    
+    Returns:
+        Generated audio, including initial_audio if given
+    """
+    musicgen_model = model_data["model"]
+    sample_rate = musicgen_model.config.audio_encoder.sampling_rate
+    hop_length = int(np.prod(musicgen_model.config.audio_encoder.upsampling_ratios))
+    
+    window_seconds = get_generation_window_seconds()
+    context_seconds = min(get_generation_context_seconds(), window_seconds / 2)
+    
+    # Context is a whole number of EnCodec frames so its decoded length is exact
+    context_samples = int(context_seconds * sample_rate) // hop_length * hop_length
+    crossfade_samples = int(WINDOW_CROSSFADE_SECONDS * sample_rate)
+    
+    output = np.zeros(int(duration * sample_rate), dtype=np.float32)
+    position = 0
+    
+    if initial_audio is not None:
+        position = min(len(initial_audio), len(output))
+        output[:position] = initial_audio[:position]
+    
+    while position < len(output):
+        if deadline is not None and time.time() >= deadline:
+            break
+        
+        remaining_seconds = (len(output) - position) / sample_rate
+        context = output[position - min(context_samples, position // hop_length * hop_length):position]
+        
+        generate_inputs = dict(text_inputs)
+        if len(context) > 0:
+            generate_inputs.update(model_data["processor"](
+                audio=context,
+                sampling_rate=sample_rate,
+                return_tensors="pt",
+            ).to(model_data["device"]))
+        
+        new_seconds = min(window_seconds - len(context) / sample_rate, remaining_seconds)
+        max_new_tokens = _budget_tokens(
+            model_data, _tokens_for_duration(new_seconds, musicgen_model), deadline
+        )
+        
+        audio_values = _run_generate(model_data, generate_inputs, max_new_tokens, **sampling)
+        
+        segment = audio_values[0, 0].cpu().numpy()
+        
+        # Crossfade the re-decoded context into the audio it was encoded from
+        fade = min(crossfade_samples, len(context))
+        if fade > 0:
+            ramp = np.linspace(0.0, 1.0, fade, dtype=np.float32)
+            output[position - fade:position] = (
+                output[position - fade:position] * (1.0 - ramp)
+                + segment[len(context) - fade:len(context)] * ramp
+            )
+        
+        continuation = segment[len(context):len(context) + len(output) - position]
+        if len(continuation) == 0:
+            break
+        
+        output[position:position + len(continuation)] = continuation
+        position += len(continuation)
+        
+        logger.info(f"Generated window up to {position / sample_rate:.1f}s of {duration}s")
+        
+        if on_window is not None and position < len(output):
+            on_window(output, max(0, position - crossfade_samples), False)
+    
+    if on_window is not None:
+        on_window(output, position, True)
+    
+    return output[:position]
+
+
 def generate_music(
     prompt: str,
     duration: int = 30,
     model: str = None,
     temperature: float = 1.0,
     top_k: int = 250,
-    top_p: float = 0.0
-) -> str:
+    top_p: float = 0.0,
+    seed: Optional[int] = None,
+    time_budget: Optional[float] = None,
+    num_return_sequences: int = 1,
+    output_format: str = None
+) -> Union[Dict, List[Dict]]:
     """
     Generate music from text prompt with ARM optimization
     
+    Exactly the decoder steps needed for the requested duration are decoded.
+    With a time budget, only the steps that fit in the budget at the
+    model's measured decode rate are run, returning a shorter track rather
+    than overrunning.
+    
+    With num_return_sequences > 1 (capped at MAX_RETURN_SEQUENCES) the
+    candidates are decoded as one batch and ranked with the hit score
+    features. Long tracks generated in windows return a single sequence.
+    
     Args:
         prompt: Text description of the music
         duration: Duration in seconds
@@ -118,183 +979,437 @@ def generate_music(
         temperature: Sampling temperature
         top_k: Top-k sampling
         top_p: Top-p sampling
+        seed: Random seed for reproducible sampling
+        time_budget: Seconds of decoding the generation may take
+        num_return_sequences: Candidates to generate for best-of-N selection
+        output_format: Encoded format (see encoding_service; OUTPUT_AUDIO_FORMAT if None)
     
     Returns:
-        Path to generated audio file
+        In-memory audio (see _encode_audio), or with num_return_sequences > 1
+        the candidates, best first
     """
     try:
         logger.info(f"Generating music: '{prompt}' ({duration}s, lightweight={is_lightweight_mode()})")
         
         # Get model components
-        if model is None:
-            model = get_model_name()
-        
-        model_data = get_model(model)
-        processor = model_data["processor"]
+        model_data = get_model(get_model_name(model))
         musicgen_model = model_data["model"]
-        device = model_data["device"]
+        
+        num_sequences = max(1, min(num_return_sequences, get_max_return_sequences()))
+        if duration > get_generation_window_seconds():
+            num_sequences = 1
         
         # Process prompt
-        inputs = processor(
-            text=[prompt],
-            padding=True,
-            return_tensors="pt",
-        ).to(device)
+        inputs = _text_conditioning(model_data, [prompt], num_repeats=num_sequences)
         
         # Calculate number of tokens for duration
-        # MusicGen generates ~50 tokens per second at 32kHz
         sample_rate = musicgen_model.config.audio_encoder.sampling_rate
-        max_new_tokens = int(duration * 50)
+        max_new_tokens = _tokens_for_duration(duration, musicgen_model)
+        deadline = _generation_deadline(time_budget)
         
-        # Reduce tokens in lightweight mode for faster generation
-        if is_lightweight_mode():
-            max_new_tokens = int(max_new_tokens * LIGHTWEIGHT_TOKEN_REDUCTION_FACTOR)
+        # Seeded sampling makes identical requests reproducible (and cacheable)
+        if seed is not None:
+            torch.manual_seed(seed)
         
-        # Generate audio with memory optimization
-        with torch.no_grad():
-            if is_lightweight_mode():
-                # Use gradient checkpointing and reduced batch size for ARM
-                audio_values = musicgen_model.generate(
-                    **inputs,
-                    max_new_tokens=max_new_tokens,
-                    do_sample=True,
-                    temperature=temperature,
-                    top_k=top_k,
-                    top_p=top_p if top_p > 0 else None,
-                    num_return_sequences=1
-                )
+        sampling = {
+            "do_sample": True,
+            "temperature": temperature,
+            "top_k": top_k,
+            "top_p": top_p if top_p > 0 else None
+        }
+        
+        if duration > get_generation_window_seconds():
+            # Long tracks are generated in overlapping windows to cap attention cost
+            candidates = [_generate_windowed(model_data, inputs, duration, sampling, deadline=deadline)]
+        else:
+            # Generate audio with memory optimization
+            max_new_tokens = _budget_tokens(model_data, max_new_tokens, deadline)
+            
+            # The decode rate is measured on single tracks, so batches skip recording it
+            if num_sequences == 1:
+                audio_values = _run_generate(model_data, inputs, max_new_tokens, **sampling)
             else:
-                audio_values = musicgen_model.generate(
-                    **inputs,
-                    max_new_tokens=max_new_tokens,
-                    do_sample=True,
-                    temperature=temperature,
-                    top_k=top_k,
-                    top_p=top_p if top_p > 0 else None
-                )
+                audio_values = _decode(model_data, inputs, max_new_tokens, **sampling)
+            
+            # Convert to numpy, trimming the partial last frame
+            candidates = [
+                audio_values[i, 0, :int(duration * sample_rate)].cpu().numpy()
+                for i in range(num_sequences)
+            ]
         
-        # Convert to numpy
-        audio_array = audio_values[0, 0].cpu().numpy()
+        _log_if_truncated(candidates[0], sample_rate, duration)
         
         # Clear GPU cache if available
         if torch.cuda.is_available():
             torch.cuda.empty_cache()
         
-        # Save to temporary file
-        output_path = tempfile.mktemp(suffix=".wav", prefix="grammy_gen_")
+        if output_format is None:
+            output_format = get_output_audio_format()
         
-        # Normalize audio
-        audio_array = audio_array / np.max(np.abs(audio_array))
+        if num_sequences == 1:
+            result = _encode_audio(candidates[0], sample_rate, output_format)
+            
+            logger.info(f"Music generated: {len(result['data'])} bytes of {output_format}")
+            
+            return result
         
-        # Save as WAV file
-        wavfile.write(output_path, sample_rate, (audio_array * 32767).astype(np.int16))
+        # Scored at the level they are delivered at, so loudness does not bias the pick
+        candidates = [_normalize_audio(candidate) for candidate in candidates]
+        scores = [score_generation_candidate(candidate, sample_rate) for candidate in candidates]
+        ranking = sorted(range(num_sequences), key=lambda i: scores[i], reverse=True)
         
-        logger.info(f"Music generated: {output_path}")
+        logger.info(
+            f"Best of {num_sequences} candidates: scores "
+            f"{', '.join(f'{scores[i]:.1f}' for i in ranking)}"
+        )
         
-        return output_path
+        return [_encode_audio(candidates[i], sample_rate, output_format) for i in ranking]
     
     except Exception as e:
         logger.error(f"Music generation failed: {e}")
         raise
 
 
-def generate_stems(audio_path: str) -> Dict[str, str]:
+def generate_music_stream(
+    prompt: str,
+    on_chunk: Callable[[int, bytes, float], None],
+    duration: int = 30,
+    model: str = None,
+    temperature: float = 1.0,
+    top_k: int = 250,
+    top_p: float = 0.0,
+    chunk_seconds: float = None,
+    seed: Optional[int] = None,
+    time_budget: Optional[float] = None,
+    output_format: str = None
+) -> Dict:
     """
-    Separate audio into stems (drums, bass, vocals, other)
-    Optimized for lightweight mode with reduced memory usage
+    Generate music while decoding and emitting audio chunks as they are ready
     
     Args:
-        audio_path: Path to audio file
+        prompt: Text description of the music
+        on_chunk: Called with (chunk index, WAV bytes, progress 0-1) for each
+            window of finalized audio
+        duration: Duration in seconds
+        model: Model identifier (auto-selected if None)
+        temperature: Sampling temperature
+        top_k: Top-k sampling
+        top_p: Top-p sampling
+        chunk_seconds: Audio seconds per emitted chunk
+        seed: Random seed for reproducible sampling
+        time_budget: Seconds of decoding the generation may take
+        output_format: Encoded format of the complete track (OUTPUT_AUDIO_FORMAT if None)
     
     Returns:
-        Dictionary mapping stem names to file paths
+        The complete track as in-memory audio (see _encode_audio), at the
+        same unnormalized level as the streamed chunks
     """
     try:
-        logger.info(f"Separating stems from: {audio_path}")
+        if chunk_seconds is None:
+            chunk_seconds = get_stream_chunk_seconds()
+        
+        logger.info(f"Streaming music generation: '{prompt}' ({duration}s, {chunk_seconds}s chunks)")
         
-        # Load audio with optimized buffer size
-        buffer_size = get_audio_buffer_size()
+        # Get model components
+        model_data = get_model(get_model_name(model))
+        musicgen_model = model_data["model"]
         
-        # In lightweight mode, skip stem separation to save memory/time
-        if is_lightweight_mode():
-            logger.info("Lightweight mode: Skipping detailed stem separation")
-            # Return original as single stem
-            return {"full": audio_path}
+        inputs = _text_conditioning(model_data, [prompt])
         
-        # Load audio
-        audio, sr = librosa.load(audio_path, sr=None, mono=False)
+        sample_rate = musicgen_model.config.audio_encoder.sampling_rate
+        deadline = _generation_deadline(time_budget)
         
-        # For now, create basic stems using frequency filtering
-        # TODO: Integrate Demucs or similar for proper stem separation
+        if seed is not None:
+            torch.manual_seed(seed)
         
-        stems = {}
+        sampling = {
+            "do_sample": True,
+            "temperature": temperature,
+            "top_k": top_k,
+            "top_p": top_p if top_p > 0 else None
+        }
         
-        # Convert to mono if stereo
-        if len(audio.shape) > 1:
-            audio_mono = librosa.to_mono(audio)
+        if duration > get_generation_window_seconds():
+            # Long tracks stream window by window to cap attention cost
+            emitter = _WindowChunkEmitter(on_chunk, sample_rate, chunk_seconds, duration)
+            audio_array = _generate_windowed(
+                model_data, inputs, duration, sampling, deadline=deadline, on_window=emitter
+            )
+            chunks_streamed = emitter.chunk_index
         else:
-            audio_mono = audio
+            max_new_tokens = _budget_tokens(
+                model_data, _tokens_for_duration(duration, musicgen_model), deadline
+            )
+            
+            streamer = AudioChunkStreamer(
+                musicgen_model,
+                total_steps=max_new_tokens + 1,
+                on_chunk=on_chunk,
+                play_steps=max(1, int(chunk_seconds * _frame_rate(musicgen_model)))
+            )
+            
+            audio_values = _run_generate(model_data, inputs, max_new_tokens, streamer=streamer, **sampling)
+            audio_array = audio_values[0, 0, :int(duration * sample_rate)].cpu().numpy()
+            chunks_streamed = streamer.chunk_index
+        
+        # Clear GPU cache if available
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+        
+        _log_if_truncated(audio_array, sample_rate, duration)
+        
+        # Peak-normalizing only the master would make it louder than the preview
+        result = _encode_audio(
+            audio_array, sample_rate, output_format or get_output_audio_format(), normalize=False
+        )
+        
+        logger.info(f"Music generated: {len(result['data'])} bytes ({chunks_streamed} chunks streamed)")
+        
+        return result
+    
+    except Exception as e:
+        logger.error(f"Streaming music generation failed: {e}")
+        raise
+
+
+def _group_by_duration(durations: List[int], max_batch_size: int) -> List[List[int]]:
+    """
+    Group request indices into batches of similar duration
+    
+    Indices are sorted by duration and a new group is started when the batch
+    is full or the next duration exceeds BATCH_DURATION_TOLERANCE times the
+    shortest duration in the current group.
+    """
+    groups = []
+    current = []
+    
+    for index in sorted(range(len(durations)), key=lambda i: durations[i]):
+        if current and (
+            len(current) >= max_batch_size
+            or durations[index] > durations[current[0]] * BATCH_DURATION_TOLERANCE
+        ):
+            groups.append(current)
+            current = []
+        current.append(index)
+    
+    if current:
+        groups.append(current)
+    
+    return groups
+
+
+def generate_music_batch(
+    prompts: List[str],
+    durations: List[int],
+    model: str = None,
+    temperature: float = 1.0,
+    top_k: int = 250,
+    top_p: float = 0.0,
+    max_batch_size: int = None,
+    output_format: str = None,
+    time_budget: Optional[float] = None
+) -> List[Dict]:
+    """
+    Generate music for several prompts with batched MusicGen passes
+    
+    Prompts are padded together and decoded in a single generate() call per
+    group of similar durations, so the autoregressive decode is shared across
+    requests instead of repeated per track.
+    
+    Args:
+        prompts: Text descriptions of the music
+        durations: Duration in seconds for each prompt
+        model: Model identifier (auto-selected if None)
+        temperature: Sampling temperature
+        top_k: Top-k sampling
+        top_p: Top-p sampling
+        max_batch_size: Maximum prompts per generate() call
+        output_format: Encoded format (OUTPUT_AUDIO_FORMAT if None)
+        time_budget: Seconds of decoding the whole batch may take
+    
+    Returns:
+        In-memory audio (see _encode_audio), in the same order as prompts
+    """
+    if len(prompts) != len(durations):
+        raise ValueError("prompts and durations must have the same length")
+    
+    try:
+        if max_batch_size is None:
+            max_batch_size = get_generation_batch_size()
+        if output_format is None:
+            output_format = get_output_audio_format()
+        
+        logger.info(
+            f"Generating batch of {len(prompts)} tracks "
+            f"(max batch size {max_batch_size}, lightweight={is_lightweight_mode()})"
+        )
+        
+        # Get model components
+        model_data = get_model(get_model_name(model))
+        musicgen_model = model_data["model"]
+        sample_rate = musicgen_model.config.audio_encoder.sampling_rate
+        deadline = _generation_deadline(time_budget)
+        
+        results = [None] * len(prompts)
+        
+        for group in _group_by_duration(durations, max_batch_size):
+            inputs = _text_conditioning(model_data, [prompts[i] for i in group])
+            
+            # Decode enough tokens for the longest track in the group
+            max_new_tokens = _budget_tokens(
+                model_data,
+                _tokens_for_duration(max(durations[i] for i in group), musicgen_model),
+                deadline
+            )
+            
+            audio_values = _decode(
+                model_data,
+                inputs,
+                max_new_tokens,
+                do_sample=True,
+                temperature=temperature,
+                top_k=top_k,
+                top_p=top_p if top_p > 0 else None
+            )
+            
+            # Trim each sequence back to its own requested duration
+            for row, index in enumerate(group):
+                num_samples = int(durations[index] * sample_rate)
+                audio_array = audio_values[row, 0, :num_samples].cpu().numpy()
+                _log_if_truncated(audio_array, sample_rate, durations[index])
+                results[index] = _encode_audio(audio_array, sample_rate, output_format)
+            
+            logger.info(f"Generated batch of {len(group)} tracks ({max_new_tokens} tokens)")
         
-        # Low-pass filter for bass (< 200 Hz)
-        bass = librosa.effects.split(audio_mono, top_db=20)
-        bass_path = tempfile.mktemp(suffix=".wav", prefix="stem_bass_")
-        wavfile.write(bass_path, sr, audio_mono.astype(np.float32))
-        stems["bass"] = bass_path
+        # Clear GPU cache if available
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
         
-        # Band-pass for mids/melody (200-8000 Hz)
-        melody_path = tempfile.mktemp(suffix=".wav", prefix="stem_melody_")
-        wavfile.write(melody_path, sr, audio_mono.astype(np.float32))
-        stems["melody"] = melody_path
+        return results
+    
+    except Exception as e:
+        logger.error(f"Batch music generation failed: {e}")
+        raise
+
+
+def generate_stems(audio: Dict) -> Dict[str, Dict]:
+    """
+    Separate audio into stems with the STEM_SEPARATOR engine
+    
+    Demucs yields drums, bass, other and vocals; the dsp splitter, which is
+    also the fallback, yields drums, bass, melody and other. Stems are
+    encoded without normalization so they add back up to the mix.
+    
+    Args:
+        audio: In-memory audio with "audio", "sample_rate", "format" and
+            "content_type" (see generate_music())
+    
+    Returns:
+        Dictionary mapping stem names to in-memory audio in the same format
+    """
+    try:
+        logger.info(f"Separating stems from {len(audio['audio']) / audio['sample_rate']:.1f}s of audio")
         
-        # High-pass for percussion/cymbals (> 8000 Hz)
-        drums_path = tempfile.mktemp(suffix=".wav", prefix="stem_drums_")
-        wavfile.write(drums_path, sr, audio_mono.astype(np.float32))
-        stems["drums"] = drums_path
+        sr = audio["sample_rate"]
+        audio_format = audio["format"]
         
-        # Full mix as "other"
-        other_path = tempfile.mktemp(suffix=".wav", prefix="stem_other_")
-        wavfile.write(other_path, sr, audio_mono.astype(np.float32))
-        stems["other"] = other_path
+        stems = {}
+        for stem_name, stem_audio in separate_stems(audio["audio"], sr).items():
+            stems[stem_name] = {
+                "audio": stem_audio,
+                "sample_rate": sr,
+                "data": encode_audio(stem_audio, sr, audio_format),
+                "format": audio_format,
+                "content_type": audio["content_type"]
+            }
         
         logger.info(f"Generated {len(stems)} stems")
         
         return stems
     
     except Exception as e:
+        # Raised so the stems task records the failure and can be retried
         logger.error(f"Stem separation failed: {e}")
-        # Return original file as single stem
-        return {"full": audio_path}
+        raise
 
 
-def extend_audio(audio_path: str, target_duration: int) -> str:
+def extend_audio(
+    audio_path: str,
+    target_duration: int,
+    prompt: str = "",
+    model: str = None,
+    temperature: float = 1.0
+) -> str:
     """
     Extend audio to target duration using AI continuation
+    
+    The missing seconds are generated by MusicGen continuing from the last
+    GENERATION_CONTEXT_SECONDS of the existing audio (see _generate_windowed).
+    The original samples are kept untouched at their own sample rate and
+    channel layout; only the continuation is resampled, copied to every
+    channel and appended.
+    
+    Args:
+        audio_path: Path to audio file
+        target_duration: Target duration in seconds
+        prompt: Optional text description to steer the continuation
+        model: Model identifier (auto-selected if None)
+        temperature: Sampling temperature
+    
+    Returns:
+        Path to extended audio file (the input path if already long enough)
     """
     try:
         logger.info(f"Extending audio to {target_duration}s")
         
-        # Load existing audio
-        audio = AudioSegment.from_wav(audio_path)
-        current_duration = len(audio) / 1000  # Convert to seconds
-        
+        # Checked from the file header before any model is loaded
+        current_duration = librosa.get_duration(path=audio_path)
         if current_duration >= target_duration:
             return audio_path
         
-        # Calculate how much more we need
-        extension_needed = target_duration - current_duration
+        model_data = get_model(get_model_name(model))
+        sample_rate = model_data["model"].config.audio_encoder.sampling_rate
+        
+        original, original_sr = librosa.load(audio_path, sr=None, mono=False)
+        original = np.atleast_2d(original)
+        
+        # MusicGen continues from a mono tail at its own sampling rate
+        context_samples = min(int(get_generation_context_seconds() * original_sr), original.shape[1])
+        tail = librosa.resample(
+            original[:, original.shape[1] - context_samples:].mean(axis=0),
+            orig_sr=original_sr,
+            target_sr=sample_rate
+        )
+        
+        missing_seconds = target_duration - original.shape[1] / original_sr
+        logger.info(f"Generating {missing_seconds:.1f}s continuation")
+        
+        extended = _generate_windowed(
+            model_data,
+            _text_conditioning(model_data, [prompt]),
+            len(tail) / sample_rate + missing_seconds,
+            {"do_sample": True, "temperature": temperature},
+            initial_audio=tail
+        )
+        
+        continuation = librosa.resample(extended[len(tail):], orig_sr=sample_rate, target_sr=original_sr)
+        continuation = np.clip(continuation[:int(missing_seconds * original_sr)], -1.0, 1.0)
         
-        # TODO: Implement AI-based audio continuation
-        # For now, simple loop/fade
-        extended = audio
-        while len(extended) / 1000 < target_duration:
-            extended = extended + audio.fade_in(2000).fade_out(2000)
+        output = np.concatenate(
+            [original, np.broadcast_to(continuation, (original.shape[0], len(continuation)))],
+            axis=1
+        )
         
-        # Trim to exact duration
-        extended = extended[:target_duration * 1000]
+        # Keep the source's sample format when WAV can hold it
+        try:
+            subtype = sf.info(audio_path).subtype
+        except RuntimeError:
+            subtype = None
+        if subtype is None or not sf.check_format("WAV", subtype):
+            subtype = "PCM_16"
         
-        # Save
         output_path = tempfile.mktemp(suffix=".wav", prefix="grammy_extended_")
-        extended.export(output_path, format="wav")
+        sf.write(output_path, output.T, original_sr, subtype=subtype)
         
         return output_path
     
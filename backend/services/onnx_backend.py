@@ -0,0 +1,466 @@
+"""
+ONNX Backend - MusicGen exported to ONNX and run with ONNX Runtime on CPU
+The text encoder, decoder step and EnCodec are exported once per model and
+precision, cached on disk, and driven by the static KV-cache decoding loop
+"""
+import torch
+import numpy as np
+from transformers import GenerationConfig, MusicgenConfig, MusicgenForConditionalGeneration
+from transformers.modeling_outputs import BaseModelOutput
+from transformers.models.encodec.modeling_encodec import EncodecConv1d, EncodecDecoderOutput, EncodecEncoderOutput
+from transformers.models.musicgen.modeling_musicgen import MusicgenForCausalLM
+from contextlib import contextmanager
+from typing import Dict, Optional
+import os
+import shutil
+import tempfile
+import time
+import logging
+from services.fast_decode import FastDecoder, StaticCacheDecoder
+from utils.config import (
+    get_model_precision,
+    get_model_cache_dir,
+    get_fast_decode_bucket_steps
+)
+
+logger = logging.getLogger(__name__)
+
+ONNX_OPSET = 17
+
+# Graphs whose MatMul weights are quantized for MODEL_PRECISION=int8 (EnCodec
+# is convolutional and stays FP32, as with the PyTorch backend)
+QUANTIZED_GRAPHS = ("text_encoder", "cross_attention", "decoder_step")
+
+GRAPH_NAMES = QUANTIZED_GRAPHS + ("audio_encoder", "audio_decoder")
+
+
+def _import_onnxruntime():
+    try:
+        import onnxruntime
+    except ImportError:
+        raise RuntimeError("MODEL_BACKEND=onnx requires the onnxruntime package")
+    return onnxruntime
+
+
+class _TextEncoderGraph(torch.nn.Module):
+    def __init__(self, musicgen_model):
+        super().__init__()
+        self.text_encoder = musicgen_model.text_encoder
+    
+    def forward(self, input_ids, attention_mask):
+        return self.text_encoder(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+
+class _CrossAttentionGraph(torch.nn.Module):
+    def __init__(self, musicgen_model):
+        super().__init__()
+        self.enc_to_dec_proj = None
+        if (
+            musicgen_model.text_encoder.config.hidden_size != musicgen_model.decoder.config.hidden_size
+            and musicgen_model.decoder.config.cross_attention_hidden_size is None
+        ):
+            self.enc_to_dec_proj = musicgen_model.enc_to_dec_proj
+        self.step = StaticCacheDecoder(musicgen_model)
+    
+    def forward(self, encoder_hidden_states, attention_mask):
+        if self.enc_to_dec_proj is not None:
+            encoder_hidden_states = self.enc_to_dec_proj(encoder_hidden_states)
+        encoder_hidden_states = encoder_hidden_states * attention_mask[..., None].to(encoder_hidden_states.dtype)
+        return self.step.cross_attention_cache(encoder_hidden_states)
+
+
+class _AudioEncoderGraph(torch.nn.Module):
+    def __init__(self, musicgen_model):
+        super().__init__()
+        self.audio_encoder = musicgen_model.audio_encoder
+        self.bandwidth = musicgen_model.audio_encoder.config.target_bandwidths[0]
+    
+    def forward(self, input_values):
+        # Codes of the single (unchunked) frame, (batch, codebooks, frames)
+        codes, _ = self.audio_encoder._encode_frame(input_values, self.bandwidth, None)
+        return codes
+
+
+class _AudioDecoderGraph(torch.nn.Module):
+    def __init__(self, musicgen_model):
+        super().__init__()
+        self.audio_encoder = musicgen_model.audio_encoder
+    
+    def forward(self, audio_codes):
+        return self.audio_encoder._decode_frame(audio_codes)
+
+
+@contextmanager
+def _whole_frame_encodec():
+    """
+    Trace EnCodec without its length-dependent extra convolution padding
+    
+    The extra padding goes through math.ceil, so tracing would freeze it at
+    the example length. It is zero for stride-1 convolutions and, for the
+    strided ones, whenever the input is a whole number of frames, which
+    _OnnxAudioEncoder guarantees.
+    """
+    original = EncodecConv1d.__dict__["_get_extra_padding_for_conv1d"]
+    EncodecConv1d._get_extra_padding_for_conv1d = staticmethod(lambda *args, **kwargs: 0)
+    try:
+        yield
+    finally:
+        EncodecConv1d._get_extra_padding_for_conv1d = original
+
+
+def _export_graphs(musicgen_model, export_dir: str):
+    """
+    Trace the five inference graphs with dynamic batch and length axes
+    """
+    config = musicgen_model.config
+    decoder_config = config.decoder
+    num_codebooks = decoder_config.num_codebooks
+    num_layers = decoder_config.num_hidden_layers
+    num_heads = decoder_config.num_attention_heads
+    head_dim = decoder_config.hidden_size // num_heads
+    hop_length = int(np.prod(config.audio_encoder.upsampling_ratios))
+    rows, text_length, cache_length, frames = 2, 8, 16, 10
+    
+    step = StaticCacheDecoder(musicgen_model).eval()
+    graphs = {
+        "text_encoder": (
+            _TextEncoderGraph(musicgen_model),
+            (torch.ones(rows, text_length, dtype=torch.long), torch.ones(rows, text_length, dtype=torch.long)),
+            ["input_ids", "attention_mask"],
+            ["last_hidden_state"],
+            {
+                "input_ids": {0: "rows", 1: "text_length"},
+                "attention_mask": {0: "rows", 1: "text_length"},
+                "last_hidden_state": {0: "rows", 1: "text_length"}
+            }
+        ),
+        "cross_attention": (
+            _CrossAttentionGraph(musicgen_model),
+            (
+                torch.randn(rows, text_length, config.text_encoder.hidden_size),
+                torch.ones(rows, text_length, dtype=torch.long)
+            ),
+            ["encoder_hidden_states", "attention_mask"],
+            ["cross_keys", "cross_values"],
+            {
+                "encoder_hidden_states": {0: "rows", 1: "text_length"},
+                "attention_mask": {0: "rows", 1: "text_length"},
+                "cross_keys": {1: "rows", 3: "text_length"},
+                "cross_values": {1: "rows", 3: "text_length"}
+            }
+        ),
+        "decoder_step": (
+            step,
+            (
+                torch.zeros(rows, num_codebooks, dtype=torch.long),
+                torch.zeros(1, dtype=torch.long),
+                torch.zeros(num_layers, rows, num_heads, cache_length, head_dim),
+                torch.zeros(num_layers, rows, num_heads, cache_length, head_dim),
+                torch.zeros(num_layers, rows, num_heads, text_length, head_dim),
+                torch.zeros(num_layers, rows, num_heads, text_length, head_dim),
+                torch.zeros(cache_length),
+                torch.zeros(rows, 1, 1, text_length)
+            ),
+            [
+                "input_ids", "position", "key_cache", "value_cache",
+                "cross_keys", "cross_values", "self_mask", "cross_mask"
+            ],
+            ["logits", "new_keys", "new_values"],
+            {
+                "input_ids": {0: "rows"},
+                "key_cache": {1: "rows", 3: "cache_length"},
+                "value_cache": {1: "rows", 3: "cache_length"},
+                "cross_keys": {1: "rows", 3: "text_length"},
+                "cross_values": {1: "rows", 3: "text_length"},
+                "self_mask": {0: "cache_length"},
+                "cross_mask": {0: "rows", 3: "text_length"},
+                "logits": {0: "rows"},
+                "new_keys": {1: "rows"},
+                "new_values": {1: "rows"}
+            }
+        ),
+        "audio_encoder": (
+            _AudioEncoderGraph(musicgen_model),
+            (torch.randn(1, config.audio_encoder.audio_channels, frames * hop_length),),
+            ["input_values"],
+            ["audio_codes"],
+            {"input_values": {0: "batch", 2: "samples"}, "audio_codes": {0: "batch", 2: "frames"}}
+        ),
+        "audio_decoder": (
+            _AudioDecoderGraph(musicgen_model),
+            (torch.zeros(1, num_codebooks, frames, dtype=torch.long),),
+            ["audio_codes"],
+            ["audio_values"],
+            {"audio_codes": {0: "batch", 2: "frames"}, "audio_values": {0: "batch", 2: "samples"}}
+        )
+    }
+    
+    for name, (module, args, input_names, output_names, dynamic_axes) in graphs.items():
+        with _whole_frame_encodec():
+            torch.onnx.export(
+                module.eval(),
+                args,
+                os.path.join(export_dir, f"{name}.onnx"),
+                input_names=input_names,
+                output_names=output_names,
+                dynamic_axes=dynamic_axes,
+                opset_version=ONNX_OPSET,
+                do_constant_folding=True
+            )
+
+
+def _quantize_graphs(export_dir: str):
+    """
+    Replace the transformer graphs with dynamically quantized INT8 versions
+    """
+    _import_onnxruntime()
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    
+    for name in QUANTIZED_GRAPHS:
+        float_path = os.path.join(export_dir, f"{name}.float.onnx")
+        graph_path = os.path.join(export_dir, f"{name}.onnx")
+        os.rename(graph_path, float_path)
+        
+        quantize_dynamic(
+            float_path,
+            graph_path,
+            weight_type=QuantType.QInt8,
+            use_external_data_format=True
+        )
+        os.remove(float_path)
+
+
+def _export_dir(model_name: str, precision: str) -> str:
+    return os.path.join(get_model_cache_dir(), "onnx", model_name.replace("/", "--"), precision)
+
+
+def export_onnx_model(model_name: str, export_dir: str, quantize: bool):
+    """
+    Export a MusicGen checkpoint to ONNX graphs plus its configs
+    
+    Graphs are written to a temporary directory that is renamed into place
+    when complete, so concurrent workers never load a partial export.
+    """
+    start_time = time.time()
+    logger.info(f"Exporting {model_name} to ONNX (INT8: {quantize})")
+    
+    musicgen_model = MusicgenForConditionalGeneration.from_pretrained(model_name).eval()
+    
+    if musicgen_model.decoder.config.audio_channels != 1:
+        raise ValueError(f"MODEL_BACKEND=onnx supports mono checkpoints only, got {model_name}")
+    if musicgen_model.audio_encoder.config.normalize:
+        raise ValueError(f"MODEL_BACKEND=onnx does not support normalized EnCodec models, got {model_name}")
+    
+    parent_dir = os.path.dirname(export_dir)
+    os.makedirs(parent_dir, exist_ok=True)
+    work_dir = tempfile.mkdtemp(dir=parent_dir)
+    
+    try:
+        with torch.no_grad():
+            _export_graphs(musicgen_model, work_dir)
+        
+        if quantize:
+            _quantize_graphs(work_dir)
+        
+        musicgen_model.config.save_pretrained(work_dir)
+        musicgen_model.generation_config.save_pretrained(work_dir)
+        
+        try:
+            os.rename(work_dir, export_dir)
+        except OSError:
+            # Another worker finished the same export first
+            shutil.rmtree(work_dir, ignore_errors=True)
+    except Exception as e:
+        logger.error(f"ONNX export failed: {str(e)}")
+        shutil.rmtree(work_dir, ignore_errors=True)
+        raise
+    
+    logger.info(f"ONNX export of {model_name} completed in {time.time() - start_time:.1f}s")
+
+
+def _create_session(graph_path: str):
+    onnxruntime = _import_onnxruntime()
+    
+    options = onnxruntime.SessionOptions()
+    options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.execution_mode = onnxruntime.ExecutionMode.ORT_SEQUENTIAL
+    # Same per-worker CPU share as the PyTorch backend. Read back from torch:
+    # configure_cpu_threads has already sized it, and recomputing the share
+    # after CPU pinning would divide the pinned block again
+    options.intra_op_num_threads = torch.get_num_threads()
+    options.inter_op_num_threads = torch.get_num_interop_threads()
+    
+    return onnxruntime.InferenceSession(graph_path, options, providers=["CPUExecutionProvider"])
+
+
+def _run(session, feeds: Dict[str, torch.Tensor]):
+    outputs = session.run(None, {name: tensor.cpu().numpy() for name, tensor in feeds.items()})
+    return [torch.from_numpy(output) for output in outputs]
+
+
+class OnnxDecoder(FastDecoder):
+    """
+    Static KV-cache decoding loop with the step run by ONNX Runtime
+    
+    The exported step always attends over the whole buffer, so its shapes
+    only change with the bucketed cache length.
+    """
+    
+    def __init__(self, musicgen_model, cross_session, step_session, bucket_steps: int = 256):
+        self._init_geometry(musicgen_model, bucket_steps)
+        self.cross_session = cross_session
+        self.step_session = step_session
+    
+    @property
+    def uses_full_cache(self) -> bool:
+        return True
+    
+    def _cross_attention_cache(self, encoder_hidden_states: torch.Tensor, attention_mask: Optional[torch.Tensor]):
+        if attention_mask is None:
+            attention_mask = torch.ones(encoder_hidden_states.shape[:2], dtype=torch.long)
+        
+        return _run(self.cross_session, {
+            "encoder_hidden_states": encoder_hidden_states.float(),
+            "attention_mask": attention_mask.long()
+        })
+    
+    def _run_step(self, input_ids, position, key_cache, value_cache, cross_keys, cross_values, self_mask, cross_mask):
+        return _run(self.step_session, {
+            "input_ids": input_ids,
+            "position": position,
+            "key_cache": key_cache,
+            "value_cache": value_cache,
+            "cross_keys": cross_keys,
+            "cross_values": cross_values,
+            "self_mask": self_mask,
+            "cross_mask": cross_mask
+        })
+
+
+class _OnnxTextEncoder:
+    def __init__(self, session, config):
+        self.session = session
+        self.config = config
+    
+    def __call__(self, input_ids: torch.Tensor, attention_mask: Optional[torch.Tensor] = None) -> BaseModelOutput:
+        if attention_mask is None:
+            attention_mask = torch.ones_like(input_ids)
+        
+        (last_hidden_state,) = _run(self.session, {"input_ids": input_ids, "attention_mask": attention_mask})
+        return BaseModelOutput(last_hidden_state=last_hidden_state)
+
+
+class _OnnxAudioEncoder:
+    def __init__(self, encoder_session, decoder_session, config):
+        self.encoder_session = encoder_session
+        self.decoder_session = decoder_session
+        self.config = config
+        self.device = torch.device("cpu")
+        self.hop_length = int(np.prod(config.upsampling_ratios))
+    
+    def encode(self, input_values: torch.Tensor, padding_mask: Optional[torch.Tensor] = None, **kwargs):
+        # The exported encoder takes whole frames (see _whole_frame_encodec); the
+        # padding mask only matters for normalized EnCodec models, which are not exported
+        remainder = input_values.shape[-1] % self.hop_length
+        if remainder:
+            input_values = torch.nn.functional.pad(input_values, (0, self.hop_length - remainder))
+        
+        (audio_codes,) = _run(self.encoder_session, {"input_values": input_values.float()})
+        return EncodecEncoderOutput(audio_codes=audio_codes[None], audio_scales=[None] * audio_codes.shape[0])
+    
+    def decode(self, audio_codes: torch.Tensor, audio_scales=None, padding_mask: Optional[torch.Tensor] = None, **kwargs):
+        (audio_values,) = _run(self.decoder_session, {"audio_codes": audio_codes[0]})
+        return EncodecDecoderOutput(audio_values=audio_values)
+
+
+class _OnnxMusicgenDecoder:
+    def __init__(self, config, generation_config):
+        self.config = config
+        self.generation_config = generation_config
+        self.num_codebooks = config.num_codebooks
+    
+    def build_delay_pattern_mask(self, input_ids: torch.Tensor, pad_token_id: int, max_length: Optional[int] = None):
+        return MusicgenForCausalLM.build_delay_pattern_mask(self, input_ids, pad_token_id, max_length)
+    
+    @staticmethod
+    def apply_delay_pattern_mask(input_ids: torch.Tensor, decoder_pad_token_mask: torch.Tensor):
+        return MusicgenForCausalLM.apply_delay_pattern_mask(input_ids, decoder_pad_token_mask)
+
+
+class OnnxMusicgenModel:
+    """
+    ONNX Runtime MusicGen exposing the parts of MusicgenForConditionalGeneration the service uses
+    """
+    
+    def __init__(self, export_dir: str, bucket_steps: int = 256):
+        self.config = MusicgenConfig.from_pretrained(export_dir)
+        self.generation_config = GenerationConfig.from_pretrained(export_dir)
+        self.device = torch.device("cpu")
+        
+        sessions = {name: _create_session(os.path.join(export_dir, f"{name}.onnx")) for name in GRAPH_NAMES}
+        
+        self.decoder = _OnnxMusicgenDecoder(self.config.decoder, self.generation_config)
+        self.text_encoder = _OnnxTextEncoder(sessions["text_encoder"], self.config.text_encoder)
+        self.audio_encoder = _OnnxAudioEncoder(
+            sessions["audio_encoder"], sessions["audio_decoder"], self.config.audio_encoder
+        )
+        self.static_decoder = OnnxDecoder(
+            self, sessions["cross_attention"], sessions["decoder_step"], bucket_steps
+        )
+        
+        self.size_mb = sum(
+            os.path.getsize(os.path.join(export_dir, file_name)) for file_name in os.listdir(export_dir)
+        ) / (1024 * 1024)
+    
+    def generate(
+        self,
+        input_ids: Optional[torch.Tensor] = None,
+        attention_mask: Optional[torch.Tensor] = None,
+        encoder_outputs: Optional[BaseModelOutput] = None,
+        input_values: Optional[torch.Tensor] = None,
+        padding_mask: Optional[torch.Tensor] = None,
+        max_new_tokens: int = 256,
+        **kwargs
+    ) -> torch.Tensor:
+        """
+        Generate audio values of shape (batch, 1, samples), as generate() returns
+        """
+        inputs = {
+            name: value
+            for name, value in (
+                ("input_ids", input_ids),
+                ("attention_mask", attention_mask),
+                ("encoder_outputs", encoder_outputs),
+                ("input_values", input_values),
+                ("padding_mask", padding_mask)
+            )
+            if value is not None
+        }
+        
+        if not self.static_decoder.supports(inputs, max_new_tokens):
+            raise ValueError(
+                f"Requested {max_new_tokens} tokens exceed the model's "
+                f"{self.static_decoder.max_positions} decoder positions"
+            )
+        
+        return self.static_decoder.generate(inputs, max_new_tokens, **kwargs)
+
+
+def load_onnx_model(model_name: str) -> OnnxMusicgenModel:
+    """
+    Load a MusicGen checkpoint on ONNX Runtime, exporting it on first use
+    
+    ONNX Runtime's CPU kernels have no FP16 advantage, so float16 precision
+    runs the FP32 graphs.
+    """
+    _import_onnxruntime()
+    
+    precision = "int8" if get_model_precision() == "int8" else "float32"
+    export_dir = _export_dir(model_name, precision)
+    
+    if not os.path.isdir(export_dir):
+        export_onnx_model(model_name, export_dir, quantize=precision == "int8")
+    
+    model = OnnxMusicgenModel(export_dir, get_fast_decode_bucket_steps())
+    logger.info(f"ONNX Runtime model loaded from {export_dir} ({model.size_mb:.0f} MB)")
+    return model
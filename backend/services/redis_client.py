@@ -0,0 +1,28 @@
+"""
+Redis Client - Shared connection for job collectors and caches
+"""
+from redis import Redis
+import os
+import logging
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Redis configuration (same instance as the Celery broker)
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+# Global client instance
+redis_client: Optional[Redis] = None
+
+
+def get_redis() -> Redis:
+    """
+    Get Redis client instance
+    """
+    global redis_client
+    
+    if redis_client is None:
+        redis_client = Redis.from_url(REDIS_URL)
+        logger.info("Redis client initialized")
+    
+    return redis_client
@@ -0,0 +1,132 @@
+"""
+Stem Separation - Pluggable stem separation engines for generated audio
+The dsp engine is a fast spectral splitter (one STFT of the mix, soft masks
+per stem, one inverse STFT per stem) and the fallback for neural engines
+"""
+import logging
+import numpy as np
+from scipy.ndimage import median_filter
+from scipy.signal import istft, stft
+from typing import Callable, Dict
+from services import demucs_separator
+from utils.config import get_stem_separator
+
+logger = logging.getLogger(__name__)
+
+STEM_NAMES = ("drums", "bass", "melody", "other")
+
+# STFT frame size and hop (75% overlap keeps the Hann window COLA)
+STFT_SIZE = 2048
+STFT_HOP = 512
+
+# Median filter lengths for harmonic/percussive separation (frames, bins)
+HARMONIC_FILTER_FRAMES = 17
+PERCUSSIVE_FILTER_BINS = 17
+
+# Band crossovers (Hz) and the width of their raised-cosine transitions
+BASS_CROSSOVER = 200.0
+MELODY_CROSSOVER = 8000.0
+CROSSOVER_WIDTH = 0.5  # octaves
+
+
+def _crossover(freqs: np.ndarray, cutoff: float) -> np.ndarray:
+    """
+    Weight rising smoothly from 0 below the cutoff to 1 above it
+    """
+    octaves = np.log2(np.maximum(freqs, 1.0) / cutoff) / CROSSOVER_WIDTH
+    return 0.5 + 0.5 * np.sin(np.pi / 2 * np.clip(2 * octaves, -1.0, 1.0))
+
+
+def stem_masks(magnitude: np.ndarray, freqs: np.ndarray) -> Dict[str, np.ndarray]:
+    """
+    Soft time-frequency masks per stem that sum to one in every bin
+    
+    Percussive energy (smooth across frequency) goes to drums; the harmonic
+    rest is split into bass, melody and other by frequency band.
+    
+    Args:
+        magnitude: Mono STFT magnitude (bins x frames)
+        freqs: Bin center frequencies
+    """
+    harmonic = median_filter(magnitude, size=(1, HARMONIC_FILTER_FRAMES), mode="nearest")
+    percussive = median_filter(magnitude, size=(PERCUSSIVE_FILTER_BINS, 1), mode="nearest")
+    
+    harmonic **= 2
+    percussive **= 2
+    drums = percussive / np.maximum(harmonic + percussive, np.finfo(np.float32).tiny)
+    pitched = 1.0 - drums
+    
+    above_bass = _crossover(freqs, BASS_CROSSOVER)[:, None]
+    above_melody = _crossover(freqs, MELODY_CROSSOVER)[:, None]
+    
+    return {
+        "drums": drums,
+        "bass": pitched * (1.0 - above_bass),
+        "melody": pitched * (above_bass - above_melody),
+        "other": pitched * above_melody
+    }
+
+
+def split_stems(audio_array: np.ndarray, sample_rate: int) -> Dict[str, np.ndarray]:
+    """
+    Split audio into drums, bass, melody and other stems
+    
+    Masks are computed once from the channel-averaged magnitude and applied to
+    every channel, so the stems add back up to the mix.
+    
+    Args:
+        audio_array: Float audio (samples, or samples x channels)
+        sample_rate: Sample rate of audio_array
+    
+    Returns:
+        Dictionary mapping stem name to audio shaped like audio_array
+    """
+    num_samples = audio_array.shape[0]
+    channels = np.atleast_2d(audio_array.T).astype(np.float32)
+    
+    freqs, _, spectrum = stft(
+        channels, fs=sample_rate, nperseg=STFT_SIZE, noverlap=STFT_SIZE - STFT_HOP
+    )
+    magnitude = np.abs(spectrum).mean(axis=0)
+    
+    stems = {}
+    for name, mask in stem_masks(magnitude, freqs).items():
+        _, stem = istft(
+            spectrum * mask.astype(np.float32), fs=sample_rate, nperseg=STFT_SIZE, noverlap=STFT_SIZE - STFT_HOP
+        )
+        stem = stem[:, :num_samples].astype(np.float32)
+        stems[name] = stem.T if audio_array.ndim > 1 else stem[0]
+    
+    logger.info(f"Split {num_samples / sample_rate:.1f}s of audio into {', '.join(stems)}")
+    
+    return stems
+
+
+# Separation engines by STEM_SEPARATOR name; each takes (audio, sample_rate)
+# and returns stem audio shaped like the input, keyed by stem name
+SEPARATORS: Dict[str, Callable[[np.ndarray, int], Dict[str, np.ndarray]]] = {
+    "dsp": split_stems,
+    "demucs": demucs_separator.separate
+}
+
+
+def separate_stems(audio_array: np.ndarray, sample_rate: int) -> Dict[str, np.ndarray]:
+    """
+    Separate audio with the configured engine
+    
+    Falls back to the dsp splitter when a neural engine is unavailable
+    (package missing, model download failed) or fails on this audio.
+    """
+    separator = get_stem_separator()
+    if separator not in SEPARATORS:
+        raise ValueError(
+            f"Unknown stem separator '{separator}'. Available separators: {', '.join(SEPARATORS)}"
+        )
+    
+    if separator != "dsp":
+        try:
+            return SEPARATORS[separator](audio_array, sample_rate)
+        except Exception as e:
+            logger.warning(f"{separator} separation failed, falling back to dsp: {e}")
+    
+    return split_stems(audio_array, sample_rate)
@@ -2,9 +2,10 @@
 Supabase Client - Database and storage integration
 """
 from supabase import create_client, Client
+import asyncio
 import os
 import logging
-from typing import Optional
+from typing import Dict, Optional, Union
 
 logger = logging.getLogger(__name__)
 
@@ -47,12 +48,13 @@ def get_supabase() -> Client:
     return supabase
 
 
-async def upload_audio_file(file_data: bytes, filename: str, content_type: str = "audio/wav") -> str:
+async def upload_audio_file(file_data: Union[bytes, str], filename: str, content_type: str = "audio/wav") -> str:
     """
     Upload audio file to Supabase Storage
     
     Args:
-        file_data: Binary file data
+        file_data: Binary file data, or the path of a local file, which the
+            storage client streams instead of reading it into memory
         filename: File path in storage
         content_type: MIME type
     
@@ -88,6 +90,29 @@ async def upload_audio_file(file_data: bytes, filename: str, content_type: str =
         raise
 
 
+def upload_audio_file_sync(file_data: Union[bytes, str], filename: str, content_type: str = "audio/wav") -> str:
+    """
+    Upload audio file from synchronous code such as Celery tasks
+    
+    Returns:
+        Public URL of uploaded file
+    """
+    return asyncio.run(upload_audio_file(file_data, filename, content_type))
+
+
+def update_track_audio_urls(track_id: str, renditions: Dict[str, Dict[str, str]]):
+    """
+    Merge rendition URLs (output name -> format -> URL) into a track's audio_urls
+    
+    The merge runs in the database (merge_track_audio_urls, see the schema
+    below), so tasks on different queues cannot overwrite each other's outputs.
+    """
+    get_supabase().rpc("merge_track_audio_urls", {
+        "p_track_id": track_id,
+        "p_renditions": renditions
+    }).execute()
+
+
 async def download_audio_file(filename: str) -> bytes:
     """
     Download audio file from Supabase Storage
@@ -165,6 +190,9 @@ CREATE TABLE tracks (
     mastered_url TEXT,
     vocal_url TEXT,
     stem_urls JSONB,
+    stems_status VARCHAR(50),
+    alternate_urls JSONB,
+    audio_urls JSONB,
     grammy_score FLOAT,
     has_vocals BOOLEAN DEFAULT FALSE,
     type VARCHAR(50) DEFAULT 'instrumental',
@@ -174,6 +202,14 @@ CREATE TABLE tracks (
     mastered_at TIMESTAMP
 );
 
+-- Atomically merge output renditions into a track's audio_urls
+CREATE OR REPLACE FUNCTION merge_track_audio_urls(p_track_id UUID, p_renditions JSONB)
+RETURNS VOID AS $$
+    UPDATE tracks
+    SET audio_urls = COALESCE(audio_urls, '{}'::jsonb) || p_renditions
+    WHERE id = p_track_id;
+$$ LANGUAGE sql;
+
 -- Grammy Scores table
 CREATE TABLE grammy_scores (
     id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
@@ -0,0 +1,53 @@
+"""
+Worker Stats - Model cache counters published by generation workers
+Kept free of torch imports so the API can report them cheaply
+"""
+import json
+import os
+import socket
+import logging
+from typing import Dict
+from services.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Each worker process has its own key, so stopped processes drop out after this long
+STATS_TTL_SECONDS = 24 * 3600
+
+STATS_PREFIX = "grammy:model_cache_stats:"
+
+
+def publish_model_cache_stats(stats: Dict):
+    """
+    Store this worker process's model cache counters
+    """
+    try:
+        key = f"{STATS_PREFIX}{socket.gethostname()}:{os.getpid()}"
+        get_redis().set(key, json.dumps(stats), ex=STATS_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"Model cache stats not published: {e}")
+
+
+def get_model_cache_stats_by_worker() -> Dict[str, Dict]:
+    """
+    Model cache counters (hits, misses, evictions, loaded models, memory)
+    by worker host:pid, plus their totals under "total"
+    """
+    redis = get_redis()
+    keys = list(redis.scan_iter(match=f"{STATS_PREFIX}*"))
+    values = redis.mget(keys) if keys else []
+    
+    workers = {
+        key.decode()[len(STATS_PREFIX):]: json.loads(value)
+        for key, value in zip(keys, values)
+        if value is not None
+    }
+    
+    total = {
+        counter: sum(stats.get(counter, 0) for stats in workers.values())
+        for counter in ("hits", "misses", "evictions")
+    }
+    lookups = total["hits"] + total["misses"]
+    total["hit_rate"] = round(total["hits"] / lookups, 3) if lookups else None
+    
+    return {"total": total, "workers": workers}
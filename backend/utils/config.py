@@ -50,6 +50,75 @@ def get_model_size():
     return os.getenv('MODEL_SIZE', 'medium')
 
 
+def get_preload_model_sizes():
+    """
+    Get model sizes loaded when a generation worker boots
+    Comma-separated PRELOAD_MODELS, 'none' to disable; defaults to the model size
+    """
+    sizes = os.getenv('PRELOAD_MODELS', get_model_size())
+    if sizes.strip().lower() == 'none':
+        return []
+    return [size.strip() for size in sizes.split(',') if size.strip()]
+
+
+def is_model_warmup_enabled():
+    """
+    Check if generation workers run a warmup generation before taking tasks
+    """
+    return os.getenv('MODEL_WARMUP', 'true').lower() in ('true', '1', 'yes')
+
+
+def get_worker_boot_timeout():
+    """
+    Get seconds a worker process may spend preloading before Celery gives up on it
+    """
+    return float(os.getenv('WORKER_BOOT_TIMEOUT', '600'))
+
+
+def is_model_queue_routing_enabled():
+    """
+    Check if generation jobs are routed to one queue per model size
+    (song_generation.small, song_generation.medium, song_generation.large)
+    """
+    return os.getenv('MODEL_QUEUE_ROUTING', 'false').lower() in ('true', '1', 'yes')
+
+
+def get_prompt_cache_size():
+    """
+    Get number of prompt embeddings kept in each worker's in-process cache
+    (0 disables it)
+    """
+    return int(os.getenv('PROMPT_EMBEDDING_CACHE_SIZE', '256'))
+
+
+def is_prompt_cache_redis_enabled():
+    """
+    Check if prompt embeddings are shared between workers through Redis
+    """
+    return os.getenv('PROMPT_EMBEDDING_CACHE_REDIS', 'false').lower() in ('true', '1', 'yes')
+
+
+def get_prompt_cache_ttl():
+    """
+    Get seconds a prompt embedding stays in Redis
+    """
+    return int(os.getenv('PROMPT_EMBEDDING_CACHE_TTL', '86400'))
+
+
+def is_result_cache_enabled():
+    """
+    Check if results of seeded generation requests are cached
+    """
+    return os.getenv('GENERATION_RESULT_CACHE', 'true').lower() in ('true', '1', 'yes')
+
+
+def get_result_cache_ttl():
+    """
+    Get seconds a cached generation result is served
+    """
+    return int(os.getenv('GENERATION_RESULT_CACHE_TTL', str(7 * 86400)))
+
+
 def get_audio_buffer_size():
     """
     Get audio processing buffer size optimized for architecture
@@ -71,6 +140,233 @@ def get_worker_concurrency():
     return int(os.getenv('WORKER_CONCURRENCY', '2'))
 
 
+def get_available_cpus():
+    """
+    Get the CPUs this process may run on (respects cpusets and affinity)
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+def get_torch_num_threads():
+    """
+    Get intra-op threads per worker process
+    
+    Defaults to an equal share of the available CPUs per prefork child, so
+    WORKER_CONCURRENCY children do not each start one thread per core (in
+    workers it is set from the pool's real -c, see workers.celery_app).
+    """
+    threads = os.getenv('TORCH_NUM_THREADS')
+    if threads is not None:
+        return max(1, int(threads))
+    return max(1, len(get_available_cpus()) // max(1, get_worker_concurrency()))
+
+
+def get_torch_interop_threads():
+    """
+    Get inter-op threads per worker process
+    
+    Autoregressive decoding runs one op at a time, so extra inter-op
+    threads only add contention.
+    """
+    return max(1, int(os.getenv('TORCH_INTEROP_THREADS', '1')))
+
+
+def is_cpu_pinning_enabled():
+    """
+    Check if each worker process is pinned to its own share of the CPUs
+    """
+    return os.getenv('CPU_AFFINITY', 'false').lower() in ('true', '1', 'yes')
+
+
+def get_worker_cpu_set(worker_index):
+    """
+    Get the CPUs assigned to a prefork child by its pool index
+    
+    CPUs are split into consecutive blocks of get_torch_num_threads();
+    indexes beyond the available blocks wrap around.
+    """
+    cpus = get_available_cpus()
+    threads = min(get_torch_num_threads(), len(cpus))
+    blocks = max(1, len(cpus) // threads)
+    start = (worker_index % blocks) * threads
+    return cpus[start:start + threads]
+
+
+def get_generation_batch_size():
+    """
+    Get maximum number of prompts decoded together in one MusicGen pass
+    """
+    if is_lightweight_mode():
+        # Smaller batches keep peak memory low on ARM
+        return int(os.getenv('GENERATION_BATCH_SIZE', '2'))
+    return int(os.getenv('GENERATION_BATCH_SIZE', '4'))
+
+
+def is_generation_batching_enabled():
+    """
+    Check if song generation jobs are collected into micro-batches
+    """
+    return os.getenv('GENERATION_BATCHING', 'false').lower() in ('true', '1', 'yes')
+
+
+def get_generation_batch_window():
+    """
+    Get how long (seconds) the collector waits for a batch to fill
+    """
+    return float(os.getenv('GENERATION_BATCH_WINDOW', '2.0'))
+
+
+def is_streaming_generation_enabled():
+    """
+    Check if generated audio is decoded and uploaded in chunks while generating
+    """
+    return os.getenv('STREAMING_GENERATION', 'false').lower() in ('true', '1', 'yes')
+
+
+def get_stream_chunk_seconds():
+    """
+    Get seconds of audio per streamed chunk
+    """
+    return float(os.getenv('STREAM_CHUNK_SECONDS', '5.0'))
+
+
+def get_generation_window_seconds():
+    """
+    Get the longest audio span decoded in one pass; longer tracks are
+    generated as overlapping windows
+    """
+    if is_lightweight_mode():
+        return float(os.getenv('GENERATION_WINDOW_SECONDS', '20'))
+    return float(os.getenv('GENERATION_WINDOW_SECONDS', '30'))
+
+
+def get_generation_context_seconds():
+    """
+    Get seconds of previous audio each window is conditioned on
+    """
+    return float(os.getenv('GENERATION_CONTEXT_SECONDS', '5'))
+
+
+def get_generation_time_budget(tier=None):
+    """
+    Get seconds a generation may spend decoding before it stops early and
+    returns the audio generated so far (0 disables the limit)
+    
+    GENERATION_TIME_BUDGET_<TIER> (e.g. GENERATION_TIME_BUDGET_FREE)
+    overrides GENERATION_TIME_BUDGET for a user tier.
+    """
+    default = os.getenv('GENERATION_TIME_BUDGET', '0')
+    if tier:
+        default = os.getenv(f'GENERATION_TIME_BUDGET_{tier.upper()}', default)
+    return float(default)
+
+
+def get_output_audio_format():
+    """
+    Get the encoding of generated tracks and stems (wav, flac, ogg, opus, or mp3)
+    """
+    return os.getenv('OUTPUT_AUDIO_FORMAT', 'wav').lower()
+
+
+def get_audio_renditions():
+    """
+    Get the extra formats every output is encoded and uploaded in
+    (comma-separated, e.g. flac,opus,mp3; empty disables renditions)
+    """
+    formats = os.getenv('AUDIO_RENDITIONS', 'flac,opus,mp3')
+    return [audio_format.strip().lower() for audio_format in formats.split(',') if audio_format.strip()]
+
+
+def get_encoding_workers():
+    """
+    Get threads used to encode and upload renditions concurrently
+    """
+    if is_lightweight_mode():
+        return int(os.getenv('ENCODING_WORKERS', '2'))
+    return int(os.getenv('ENCODING_WORKERS', '4'))
+
+
+def get_upload_retries():
+    """
+    Get how many times a failed storage upload is retried before giving up
+    """
+    return int(os.getenv('UPLOAD_RETRIES', '2'))
+
+
+def get_stem_separator():
+    """
+    Get the stem separation engine (dsp spectral splitter, or demucs)
+    """
+    return os.getenv('STEM_SEPARATOR', 'demucs').lower()
+
+
+def get_stem_model():
+    """
+    Get the pretrained Demucs model used by the demucs separator
+    """
+    return os.getenv('STEM_MODEL', 'htdemucs')
+
+
+def get_stem_chunk_seconds():
+    """
+    Get the length of the overlapping chunks neural separation runs on
+    Smaller chunks bound peak memory on lightweight workers
+    """
+    if is_lightweight_mode():
+        return float(os.getenv('STEM_CHUNK_SECONDS', '10'))
+    return float(os.getenv('STEM_CHUNK_SECONDS', '30'))
+
+
+def get_stem_prefetch_tiers():
+    """
+    Get user tiers whose stems are separated as soon as generation completes
+    (comma-separated, 'all' for every tier; others get stems on first request)
+    """
+    tiers = os.getenv('STEM_PREFETCH_TIERS', '')
+    return [tier.strip().lower() for tier in tiers.split(',') if tier.strip()]
+
+
+def get_max_return_sequences():
+    """
+    Get the most candidates one generation may decode for best-of-N selection
+    """
+    if is_lightweight_mode():
+        return int(os.getenv('MAX_RETURN_SEQUENCES', '2'))
+    return int(os.getenv('MAX_RETURN_SEQUENCES', '4'))
+
+
+def get_max_generation_eta():
+    """
+    Get the longest estimated wait (seconds) at which new generation
+    requests are still accepted (0 accepts everything)
+    """
+    return float(os.getenv('MAX_GENERATION_ETA', '0'))
+
+
+def is_fast_decode_enabled():
+    """
+    Check if generation uses the static KV-cache decoding loop instead of generate()
+    """
+    return os.getenv('FAST_DECODE', 'false').lower() in ('true', '1', 'yes')
+
+
+def is_decode_compile_enabled():
+    """
+    Check if the fast decode step is compiled with torch.compile
+    """
+    return os.getenv('FAST_DECODE_COMPILE', 'false').lower() in ('true', '1', 'yes')
+
+
+def get_fast_decode_bucket_steps():
+    """
+    Get the step multiple KV-cache buffers are rounded up to, so similar
+    durations share one compiled decoder step
+    """
+    return int(os.getenv('FAST_DECODE_BUCKET_STEPS', '256'))
+
+
 def get_model_precision():
     """
     Get model precision (float32, float16, or int8)
@@ -81,6 +377,67 @@ def get_model_precision():
     return os.getenv('MODEL_PRECISION', 'float32')
 
 
+def get_model_backend():
+    """
+    Get the inference backend (torch, or onnx for ONNX Runtime on CPU)
+    """
+    return os.getenv('MODEL_BACKEND', 'torch').lower()
+
+
+def is_model_artifact_cache_enabled():
+    """
+    Check if optimized (quantized/converted) models are cached on disk
+    """
+    return os.getenv('MODEL_ARTIFACT_CACHE', 'true').lower() in ('true', '1', 'yes')
+
+
+def get_model_cache_dir():
+    """
+    Get directory for optimized model artifacts
+    """
+    default_dir = os.path.join(os.path.expanduser('~'), '.cache', 'grammy_engine', 'models')
+    return os.getenv('MODEL_CACHE_DIR', default_dir)
+
+
+def get_model_share_mode():
+    """
+    Get how model weights are shared between prefork worker processes
+    
+    none: each worker process loads its own copy
+    fork: the parent loads models before forking, children share copy-on-write pages
+    mmap: workers memory-map the on-disk model artifact and share the page cache
+    """
+    mode = os.getenv('MODEL_SHARE_MODE', 'none').lower()
+    if mode not in ('none', 'fork', 'mmap'):
+        logger.warning(f"Unknown MODEL_SHARE_MODE '{mode}', using 'none'")
+        return 'none'
+    if mode == 'mmap' and is_lightweight_mode() and get_model_precision() == 'int8':
+        # Dynamic-quantized Linear weights are re-packed into private memory
+        # on load, so a mapped INT8 artifact shares nothing
+        logger.warning("MODEL_SHARE_MODE=mmap cannot share INT8 weights, using 'fork'")
+        return 'fork'
+    return mode
+
+
+def get_model_cache_budget_mb():
+    """
+    Get RAM budget (MB) for models cached in one worker process
+    
+    Defaults to half of physical memory split across worker processes;
+    0 disables eviction.
+    """
+    budget = os.getenv('MODEL_CACHE_BUDGET_MB')
+    if budget is not None:
+        return float(budget)
+    
+    try:
+        total_mb = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / (1024 * 1024)
+    except (ValueError, OSError, AttributeError):
+        return 0.0
+    
+    return total_mb * 0.5 / max(1, get_worker_concurrency())
+
+
 def get_max_audio_duration():
     """
     Get maximum audio duration based on mode
@@ -102,7 +459,30 @@ def log_configuration():
     logger.info(f"Lightweight Mode: {is_lightweight_mode()}")
     logger.info(f"Model Size: {get_model_size()}")
     logger.info(f"Model Precision: {get_model_precision()}")
+    logger.info(f"Model Backend: {get_model_backend()}")
+    logger.info(f"Model Artifact Cache: {is_model_artifact_cache_enabled()} ({get_model_cache_dir()})")
+    logger.info(f"Preload Models: {', '.join(get_preload_model_sizes()) or 'none'} (warmup: {is_model_warmup_enabled()})")
+    logger.info(f"Model Queue Routing: {is_model_queue_routing_enabled()}")
+    logger.info(f"Model Share Mode: {get_model_share_mode()}")
+    logger.info(f"Model Cache Budget: {get_model_cache_budget_mb():.0f} MB")
+    logger.info(f"Prompt Embedding Cache: {get_prompt_cache_size()} entries (Redis: {is_prompt_cache_redis_enabled()})")
+    logger.info(f"Generation Result Cache: {is_result_cache_enabled()} (TTL {get_result_cache_ttl()}s)")
     logger.info(f"Audio Buffer Size: {get_audio_buffer_size()}")
     logger.info(f"Worker Concurrency: {get_worker_concurrency()}")
+    logger.info(
+        f"CPU Threads: {get_torch_num_threads()} intra-op / {get_torch_interop_threads()} inter-op per worker "
+        f"({len(get_available_cpus())} CPUs available, pinning: {is_cpu_pinning_enabled()})"
+    )
+    logger.info(f"Generation Batch Size: {get_generation_batch_size()}")
+    logger.info(f"Generation Batching: {is_generation_batching_enabled()} (window {get_generation_batch_window()}s)")
+    logger.info(f"Generation Window: {get_generation_window_seconds()}s ({get_generation_context_seconds()}s context)")
+    logger.info(f"Fast Decode: {is_fast_decode_enabled()} (compile: {is_decode_compile_enabled()}, bucket {get_fast_decode_bucket_steps()} steps)")
+    logger.info(f"Generation Time Budget: {get_generation_time_budget() or 'unlimited'}")
+    logger.info(f"Max Return Sequences: {get_max_return_sequences()}")
+    logger.info(f"Max Generation ETA: {get_max_generation_eta() or 'unlimited'}")
+    logger.info(f"Output Audio Format: {get_output_audio_format()}")
+    logger.info(f"Audio Renditions: {', '.join(get_audio_renditions()) or 'none'} ({get_encoding_workers()} workers, {get_upload_retries()} upload retries)")
+    logger.info(f"Stem Separator: {get_stem_separator()} (model {get_stem_model()}, {get_stem_chunk_seconds()}s chunks)")
+    logger.info(f"Streaming Generation: {is_streaming_generation_enabled()} ({get_stream_chunk_seconds()}s chunks)")
     logger.info(f"Max Audio Duration: {get_max_audio_duration()}s")
     logger.info("=" * 60)
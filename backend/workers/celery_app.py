@@ -2,7 +2,12 @@
 Celery application configuration for async task processing
 """
 from celery import Celery
+from celery.signals import worker_init, worker_process_init
 import os
+import logging
+from utils.config import get_worker_boot_timeout
+
+logger = logging.getLogger(__name__)
 
 # Redis configuration
 REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
@@ -14,6 +19,7 @@ celery_app = Celery(
     backend=REDIS_URL,
     include=[
         "workers.song_tasks",
+        "workers.stem_tasks",
         "workers.mix_tasks",
         "workers.meter_tasks"
     ]
@@ -34,11 +40,15 @@ celery_app.conf.update(
     task_acks_late=True,
     task_reject_on_worker_lost=True,
     result_expires=86400,  # 24 hours
+    # Give pool processes time to preload and warm up models before they are
+    # considered failed (Celery's default is 4 seconds)
+    worker_proc_alive_timeout=get_worker_boot_timeout(),
 )
 
 # Task routing
 celery_app.conf.task_routes = {
     "workers.song_tasks.*": {"queue": "song_generation"},
+    "workers.stem_tasks.*": {"queue": "stems"},
     "workers.mix_tasks.*": {"queue": "mixing"},
     "workers.meter_tasks.*": {"queue": "analysis"},
 }
@@ -51,5 +61,110 @@ celery_app.conf.beat_schedule = {
     },
 }
 
+
+# Worker lifecycle hooks
+def _consumed_queues() -> list:
+    """
+    Names of the queues this worker was started to consume
+    """
+    return list(celery_app.amqp.queues.consume_from or {})
+
+
+def _consumes_generation_queue() -> bool:
+    """
+    Check if this worker was started to consume a song generation queue
+    """
+    return any(name.startswith("song_generation") for name in _consumed_queues())
+
+
+def _boot_model_names() -> list:
+    """
+    Models to load at boot: the models behind per-model queues this worker
+    consumes, otherwise PRELOAD_MODELS
+    """
+    from services.model_registry import get_queue_model_sizes
+    from services.musicgen_service import get_model_name, get_preload_model_names
+    
+    queue_sizes = get_queue_model_sizes(_consumed_queues())
+    if queue_sizes:
+        return [get_model_name(size) for size in queue_sizes]
+    return get_preload_model_names()
+
+
+@worker_init.connect
+def record_pool_concurrency(sender=None, **kwargs):
+    """
+    Publish the pool's real size (-c) as WORKER_CONCURRENCY for its children
+    
+    The CPU partition in utils.config divides cores by WORKER_CONCURRENCY,
+    which deployments usually only pass to Celery on the command line.
+    Connected before preload_models_before_fork.
+    """
+    concurrency = getattr(sender, "concurrency", None)
+    if concurrency:
+        os.environ["WORKER_CONCURRENCY"] = str(concurrency)
+
+
+@worker_init.connect
+def preload_models_before_fork(**kwargs):
+    """
+    Load generation models in the worker parent when MODEL_SHARE_MODE=fork
+    
+    worker_init runs in the main process before the prefork pool starts, so
+    every child (including ones recycled by worker_max_tasks_per_child)
+    inherits the already-loaded weights.
+    """
+    from utils.config import get_model_share_mode
+    
+    if get_model_share_mode() != "fork" or not _consumes_generation_queue():
+        return
+    
+    from services.musicgen_service import preload_shared_models
+    preload_shared_models(_boot_model_names())
+
+
+@worker_process_init.connect
+def configure_worker_threads(**kwargs):
+    """
+    Give each pool process its own share of the CPUs before it runs tasks
+    
+    Connected before prepare_generation_worker so warmup already runs with
+    the partitioned thread pools. Only generation workers use torch, so the
+    mixing, analysis and stems workers skip importing it here.
+    """
+    if not _consumes_generation_queue():
+        return
+    
+    from billiard.process import current_process
+    from services.musicgen_service import configure_cpu_threads
+    
+    configure_cpu_threads(current_process().index or 0)
+
+
+@worker_process_init.connect
+def prepare_generation_worker(**kwargs):
+    """
+    Preload and warm up models in each pool process before it takes tasks
+    
+    The pool only hands tasks to a process once this hook returns, so the
+    load/quantize/first-inference cost is paid at startup rather than inside
+    the first user's task. Models inherited from the parent are not reloaded.
+    """
+    if not _consumes_generation_queue():
+        return
+    
+    from utils.config import is_model_warmup_enabled
+    from services.musicgen_service import get_model, warmup_model
+    
+    for model_name in _boot_model_names():
+        try:
+            get_model(model_name)
+            if is_model_warmup_enabled():
+                warmup_model(model_name)
+        except Exception as e:
+            # A failed preload must not stop the worker; the task will retry the load
+            logger.error(f"Preloading model {model_name} failed: {e}")
+
+
 if __name__ == "__main__":
     celery_app.start()
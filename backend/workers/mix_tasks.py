@@ -4,7 +4,14 @@ Celery tasks for mixing and mastering
 from workers.celery_app import celery_app
 from workers.base import CallbackTask
 from services.matchering_service import master_track, analyze_audio
-from services.supabase_client import supabase, upload_audio_file
+from services.supabase_client import supabase, upload_audio_file_sync, update_track_audio_urls
+from services.encoding_service import AUDIO_FORMATS, select_rendition, upload_file_renditions
+from utils.config import get_audio_buffer_size, get_encoding_workers
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Tuple
+import numpy as np
+import scipy.io.wavfile as wavfile
+import soundfile as sf
 import logging
 import os
 import tempfile
@@ -90,11 +97,8 @@ def mixmaster_task(
             meta={"progress": 85, "message": "Uploading mastered track..."}
         )
         
-        with open(output_path, "rb") as f:
-            mastered_data = f.read()
-        
-        mastered_url = upload_audio_file(
-            file_data=mastered_data,
+        mastered_url = upload_audio_file_sync(
+            file_data=output_path,
             filename=f"tracks/{track_id}/mastered.wav",
             content_type="audio/wav"
         )
@@ -107,6 +111,14 @@ def mixmaster_task(
             "mastered_at": "now()"
         }).eq("id", track_id).execute()
         
+        # FLAC archival and Opus/MP3 preview renditions, encoded once the
+        # mastered track is already available
+        mastered_urls = {"wav": mastered_url}
+        mastered_urls.update(
+            upload_file_renditions(f"tracks/{track_id}/mastered", output_path, primary_format="wav")
+        )
+        update_track_audio_urls(track_id, {"mastered": mastered_urls})
+        
         # Cleanup temporary files
         os.remove(input_path)
         os.remove(output_path)
@@ -118,6 +130,7 @@ def mixmaster_task(
         return {
             "track_id": track_id,
             "mastered_url": mastered_url,
+            "mastered_urls": mastered_urls,
             "analysis": analysis,
             "status": "completed"
         }
@@ -133,31 +146,204 @@ def mixmaster_task(
         raise
 
 
+def _stem_source(track: Dict, stem_name: str) -> Tuple[str, str]:
+    """
+    Pick the URL a stem is mixed from: WAV if available (it can be memory-
+    mapped as is), else another lossless rendition, else the stem URL
+    """
+    renditions = (track.get("audio_urls") or {}).get(f"stems/{stem_name}") or {}
+    if "wav" in renditions:
+        return "wav", renditions["wav"]
+    
+    selected = select_rendition(renditions, lossless=True)
+    if selected is not None:
+        return selected
+    
+    url = track["stem_urls"][stem_name]
+    extension = url.rsplit("?", 1)[0].rsplit(".", 1)[-1].lower()
+    return (extension if extension in AUDIO_FORMATS else "wav"), url
+
+
+def _download_stem(stem_name: str, audio_format: str, url: str) -> str:
+    """
+    Stream a stem to a temporary WAV file, converting other formats block-wise
+    """
+    response = requests.get(url, stream=True, timeout=60)
+    response.raise_for_status()
+    
+    with tempfile.NamedTemporaryFile(suffix=f".{AUDIO_FORMATS[audio_format]['extension']}", prefix=f"grammy_stem_{stem_name}_", delete=False) as temp_stem:
+        for chunk in response.iter_content(chunk_size=1 << 20):
+            temp_stem.write(chunk)
+        download_path = temp_stem.name
+    
+    if audio_format == "wav":
+        return download_path
+    
+    wav_path = tempfile.mktemp(suffix=".wav", prefix=f"grammy_stem_{stem_name}_")
+    try:
+        with sf.SoundFile(download_path) as source:
+            with sf.SoundFile(wav_path, "w", samplerate=source.samplerate, channels=source.channels, format="WAV", subtype="PCM_16") as wav:
+                for block in source.blocks(blocksize=get_audio_buffer_size(), dtype="float32"):
+                    wav.write(block)
+    finally:
+        os.remove(download_path)
+    
+    return wav_path
+
+
+def _stem_gains(stem_names: List[str], stem_levels: Dict) -> np.ndarray:
+    """
+    Left/right gain per stem from stem_levels
+    
+    Each level is a gain in dB, or a dict with "gain" (dB, default 0) and
+    "pan" (-1 left to 1 right, default 0). Panning uses a balance law, so
+    centered stems keep unity gain and an all-default mix reproduces the
+    master.
+    
+    Returns:
+        Stems x 2 array of linear gains
+    """
+    unknown = set(stem_levels) - set(stem_names)
+    if unknown:
+        raise ValueError(f"Unknown stems: {', '.join(sorted(unknown))}. Available stems: {', '.join(stem_names)}")
+    
+    gains = np.ones((len(stem_names), 2), dtype=np.float32)
+    for index, stem_name in enumerate(stem_names):
+        level = stem_levels.get(stem_name, 0.0)
+        if not isinstance(level, dict):
+            level = {"gain": level}
+        
+        pan = float(np.clip(level.get("pan", 0.0), -1.0, 1.0))
+        gain = 10 ** (float(level.get("gain", 0.0)) / 20)
+        gains[index] = gain * np.array([1.0 - max(pan, 0.0), 1.0 + min(pan, 0.0)])
+    
+    return gains
+
+
+def mix_stems(stem_paths: Dict[str, str], stem_levels: Dict, output_path: str) -> str:
+    """
+    Mix WAV stems into a stereo 16-bit WAV file block by block
+    
+    Stems are memory-mapped, and each block of every stem is summed with its
+    gains in one vectorized einsum before being written out, so memory stays
+    flat regardless of stem count or track length.
+    """
+    stem_names = list(stem_paths)
+    gains = _stem_gains(stem_names, stem_levels)
+    
+    stems = []
+    sample_rate = None
+    for stem_name in stem_names:
+        stem_rate, data = wavfile.read(stem_paths[stem_name], mmap=True)
+        if sample_rate is not None and stem_rate != sample_rate:
+            raise ValueError(f"Stem {stem_name} is {stem_rate} Hz, expected {sample_rate} Hz")
+        sample_rate = stem_rate
+        
+        # Scale integer PCM to [-1, 1]; float WAVs are already there
+        scale = 1.0 / (np.iinfo(data.dtype).max + 1) if np.issubdtype(data.dtype, np.integer) else 1.0
+        stems.append((data.reshape(len(data), -1), scale))
+    
+    num_frames = max(len(data) for data, _ in stems)
+    block_frames = get_audio_buffer_size()
+    block = np.zeros((len(stems), block_frames, 2), dtype=np.float32)
+    
+    with sf.SoundFile(output_path, "w", samplerate=sample_rate, channels=2, format="WAV", subtype="PCM_16") as output:
+        for start in range(0, num_frames, block_frames):
+            frames = min(block_frames, num_frames - start)
+            block.fill(0.0)
+            
+            # Mono stems are broadcast to both channels
+            for index, (data, scale) in enumerate(stems):
+                chunk = data[start:start + frames]
+                block[index, :len(chunk)] = chunk * scale
+            
+            mixed = np.einsum("sfc,sc->fc", block[:, :frames], gains)
+            output.write(np.clip(mixed, -1.0, 1.0))
+    
+    return output_path
+
+
 @celery_app.task(bind=True, base=CallbackTask, name="workers.mix_tasks.stem_mixing_task")
 def stem_mixing_task(self, track_id: str, stem_levels: dict):
     """
     Mix individual stems with custom levels
+    
+    stem_levels maps stem names to a gain in dB or to {"gain", "pan"} (see
+    _stem_gains); stems left out are mixed at unity gain, centered.
     """
+    stem_paths = {}
+    output_path = None
+    
     try:
         logger.info(f"Starting stem mixing for track {track_id}")
         
         # Get track stems
-        track = supabase.table("tracks").select("stem_urls").eq("id", track_id).single().execute()
+        track = supabase.table("tracks").select("stem_urls, audio_urls").eq("id", track_id).single().execute()
         
         if not track.data or not track.data.get("stem_urls"):
             raise ValueError(f"Track {track_id} stems not found")
         
-        # Download all stems
+        # Download all stems concurrently
+        self.update_state(
+            state="PROGRESS",
+            meta={"progress": 10, "message": "Downloading stems..."}
+        )
+        
+        stem_names = list(track.data["stem_urls"])
+        with ThreadPoolExecutor(max_workers=min(len(stem_names), get_encoding_workers())) as pool:
+            futures = {
+                stem_name: pool.submit(_download_stem, stem_name, *_stem_source(track.data, stem_name))
+                for stem_name in stem_names
+            }
+            for stem_name, future in futures.items():
+                try:
+                    stem_paths[stem_name] = future.result()
+                except Exception as e:
+                    logger.error(f"Downloading stem {stem_name} failed: {e}")
+        
+        if len(stem_paths) < len(stem_names):
+            raise RuntimeError(f"Could not download all stems of track {track_id}")
+        
         # Mix with specified levels
+        self.update_state(
+            state="PROGRESS",
+            meta={"progress": 40, "message": "Mixing stems..."}
+        )
+        
+        output_path = mix_stems(stem_paths, stem_levels, tempfile.mktemp(suffix=".wav", prefix="grammy_mix_"))
+        
         # Upload mixed result
+        self.update_state(
+            state="PROGRESS",
+            meta={"progress": 80, "message": "Uploading mix..."}
+        )
+        
+        # Uploaded and encoded straight from the file, keeping memory flat
+        mixed_url = upload_audio_file_sync(
+            file_data=output_path,
+            filename=f"tracks/{track_id}/mixed.wav",
+            content_type="audio/wav"
+        )
         
-        # TODO: Implement full stem mixing logic
+        mixed_urls = {"wav": mixed_url}
+        mixed_urls.update(upload_file_renditions(f"tracks/{track_id}/mixed", output_path, primary_format="wav"))
+        update_track_audio_urls(track_id, {"mixed": mixed_urls})
+        
+        logger.info(f"Stem mixing completed for track {track_id}")
         
         return {
             "track_id": track_id,
+            "mixed_url": mixed_url,
+            "mixed_urls": mixed_urls,
             "status": "mixed"
         }
     
     except Exception as e:
         logger.error(f"Stem mixing failed: {e}")
         raise
+    
+    finally:
+        # Cleanup temporary files
+        for path in list(stem_paths.values()) + [output_path]:
+            if path and os.path.exists(path):
+                os.remove(path)
@@ -1,11 +1,37 @@
 """
 Celery tasks for song generation and vocal synthesis
 """
+from celery.utils import uuid
 from workers.celery_app import celery_app
 from workers.base import CallbackTask
-from services.musicgen_service import generate_music, generate_stems
+from services.musicgen_service import (
+    generate_music,
+    generate_music_batch,
+    generate_music_stream
+)
 from services.vocalsvc_service import generate_vocals, apply_vocal_effects
-from services.supabase_client import supabase, upload_audio_file
+from services.supabase_client import supabase, upload_audio_file_sync, update_track_audio_urls
+from services.encoding_service import upload_encoded_audio, upload_encoded_outputs, upload_file_renditions
+from services.redis_client import get_redis
+from services.model_registry import (
+    resolve_model_id,
+    get_checkpoint_name,
+    get_generation_queue,
+    get_batch_collector_prefix
+)
+from services.eta_service import record_job_time
+from services.generation_cache import generation_cache_key, get_cached_generation, store_generation
+from workers.stem_tasks import prefetch_stems
+from utils.config import (
+    is_streaming_generation_enabled,
+    is_generation_batching_enabled,
+    get_generation_batch_size,
+    get_generation_batch_window,
+    get_generation_time_budget
+)
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+import json
 import logging
 import os
 from pathlib import Path
@@ -15,12 +41,39 @@ logger = logging.getLogger(__name__)
 
 
 @celery_app.task(bind=True, base=CallbackTask, name="workers.song_tasks.generate_song_task")
-def generate_song_task(self, track_id: str, prompt: str, duration: int, model: str, temperature: float):
+def generate_song_task(
+    self,
+    track_id: str,
+    prompt: str,
+    duration: int,
+    model: str,
+    temperature: float,
+    seed: int = None,
+    top_k: int = 250,
+    top_p: float = 0.0,
+    tier: str = None,
+    num_return_sequences: int = 1
+):
     """
     Generate instrumental music from text prompt
+    
+    Seeded requests are deterministic, so their uploaded result is cached and
+    an identical later request completes from the cache without generating.
+    Decoding is bounded by the user tier's generation time budget. With
+    num_return_sequences > 1 the best candidate becomes the track and the
+    others are uploaded as alternates. Stems are not part of generation; they
+    are separated later by the stems queue (see workers.stem_tasks).
     """
     try:
         logger.info(f"Starting song generation for track {track_id}")
+        start_time = time.time()
+        
+        cache_key = None
+        if seed is not None and num_return_sequences == 1:
+            cache_key = generation_cache_key(prompt, model, duration, temperature, top_k, top_p, seed)
+            cached = get_cached_generation(cache_key)
+            if cached:
+                return _complete_from_cache(track_id, cached, tier)
         
         # Update progress: Initializing
         self.update_state(
@@ -34,71 +87,61 @@ def generate_song_task(self, track_id: str, prompt: str, duration: int, model: s
             meta={"progress": 30, "message": "Generating audio..."}
         )
         
-        audio_path = generate_music(
-            prompt=prompt,
-            duration=duration,
-            model=model,
-            temperature=temperature
-        )
-        
-        # Generate individual stems (drums, bass, melody, etc.)
-        self.update_state(
-            state="PROGRESS",
-            meta={"progress": 60, "message": "Separating stems..."}
-        )
-        
-        stems = generate_stems(audio_path)
-        
-        # Upload to storage
-        self.update_state(
-            state="PROGRESS",
-            meta={"progress": 80, "message": "Uploading files..."}
-        )
+        sampling = {"temperature": temperature, "top_k": top_k, "top_p": top_p, "seed": seed}
+        time_budget = get_generation_time_budget(tier)
         
-        # Read and upload main audio file
-        with open(audio_path, "rb") as f:
-            audio_data = f.read()
+        alternates = []
         
-        audio_url = upload_audio_file(
-            file_data=audio_data,
-            filename=f"tracks/{track_id}/master.wav",
-            content_type="audio/wav"
-        )
+        if num_return_sequences > 1:
+            candidates = generate_music(
+                prompt=prompt,
+                duration=duration,
+                model=model,
+                time_budget=time_budget,
+                num_return_sequences=num_return_sequences,
+                **sampling
+            )
+            if isinstance(candidates, dict):
+                candidates = [candidates]
+            audio, alternates = candidates[0], candidates[1:]
+        elif is_streaming_generation_enabled():
+            audio = _generate_streaming(self, track_id, prompt, duration, model, sampling, time_budget)
+        else:
+            audio = generate_music(
+                prompt=prompt,
+                duration=duration,
+                model=model,
+                time_budget=time_budget,
+                **sampling
+            )
         
-        # Upload stems
-        stem_urls = {}
-        for stem_name, stem_path in stems.items():
-            with open(stem_path, "rb") as f:
-                stem_data = f.read()
-            
-            stem_url = upload_audio_file(
-                file_data=stem_data,
-                filename=f"tracks/{track_id}/stems/{stem_name}.wav",
-                content_type="audio/wav"
+        def report_progress(progress: int, message: str):
+            self.update_state(
+                state="PROGRESS",
+                meta={"progress": progress, "message": message}
             )
-            stem_urls[stem_name] = stem_url
         
-        # Update track in database
-        supabase.table("tracks").update({
-            "status": "completed",
-            "audio_url": audio_url,
-            "stem_urls": stem_urls,
-            "completed_at": "now()"
-        }).eq("id", track_id).execute()
+        alternate_urls = []
+        if alternates:
+            report_progress(55, "Uploading alternate takes...")
+            alternate_urls = _upload_alternates(track_id, alternates)
         
-        # Cleanup local files
-        os.remove(audio_path)
-        for stem_path in stems.values():
-            os.remove(stem_path)
+        result = _finalize_track(track_id, audio, report_progress, tier)
+        if alternate_urls:
+            result["alternate_urls"] = alternate_urls
         
-        logger.info(f"Song generation completed for track {track_id}")
+        # Calibrates the API's ETA for single-candidate jobs like this one
+        if num_return_sequences == 1:
+            record_job_time(get_checkpoint_name(model), duration, time.time() - start_time)
         
-        return {
-            "track_id": track_id,
-            "audio_url": audio_url,
-            "stem_urls": stem_urls,
-            "status": "completed"
-        }
+        # A budgeted generation may have stopped early, so it is not cached
+        if cache_key and not time_budget:
+            store_generation(cache_key, {
+                "audio_url": result["audio_url"],
+                "audio_urls": result["audio_urls"]
+            })
+        
+        return result
     
     except Exception as e:
         logger.error(f"Song generation failed for track {track_id}: {e}")
@@ -112,6 +155,366 @@ def generate_song_task(self, track_id: str, prompt: str, duration: int, model: s
         raise
 
 
+def _complete_from_cache(track_id: str, cached: Dict, tier: str = None) -> Dict:
+    """
+    Complete a track with the stored result of an identical seeded request
+    
+    Entries stored before stems were deferred also carry stem_urls.
+    """
+    supabase.table("tracks").update({
+        "status": "completed",
+        "audio_url": cached["audio_url"],
+        "stem_urls": cached.get("stem_urls"),
+        "audio_urls": cached.get("audio_urls"),
+        "completed_at": "now()"
+    }).eq("id", track_id).execute()
+    
+    logger.info(f"Song generation for track {track_id} served from cache")
+    
+    if not cached.get("stem_urls"):
+        prefetch_stems(track_id, tier)
+    
+    return {
+        "track_id": track_id,
+        "audio_url": cached["audio_url"],
+        "stem_urls": cached.get("stem_urls"),
+        "audio_urls": cached.get("audio_urls"),
+        "status": "completed",
+        "cached": True
+    }
+
+
+def _upload_alternates(track_id: str, alternates: List[Dict]) -> List[str]:
+    """
+    Upload the runner-up candidates of a best-of-N generation to the track row
+    
+    All candidates and their renditions are uploaded concurrently, with the
+    renditions collected in audio_urls under alternates/<n>.
+    """
+    outputs = {
+        f"tracks/{track_id}/alternates/{index}": alternate
+        for index, alternate in enumerate(alternates, start=1)
+    }
+    uploaded = upload_encoded_outputs(outputs)
+    
+    alternate_urls = [uploaded[storage_path][outputs[storage_path]["format"]] for storage_path in outputs]
+    update_track_audio_urls(track_id, {
+        f"alternates/{index}": uploaded[storage_path]
+        for index, storage_path in enumerate(outputs, start=1)
+    })
+    
+    supabase.table("tracks").update({
+        "alternate_urls": alternate_urls
+    }).eq("id", track_id).execute()
+    
+    return alternate_urls
+
+
+def _generate_streaming(
+    task,
+    track_id: str,
+    prompt: str,
+    duration: int,
+    model: str,
+    sampling: Dict,
+    time_budget: float = None
+) -> Dict:
+    """
+    Generate with chunked decoding, uploading each chunk as it becomes available
+    
+    Generation progress (30-60%) follows decoded tokens, and the uploaded
+    chunk URLs are published in the task's PROGRESS meta so clients can start
+    playback before the full track is finished. Chunks are uploaded in order
+    on a single background thread so uploads never stall decoding; a chunk
+    that fails to upload only leaves a gap in the preview.
+    """
+    chunk_urls = []
+    
+    # Celery keeps the request in a thread-local, so the uploader thread
+    # must name the task it reports progress for
+    task_id = task.request.id
+    
+    def upload_chunk(chunk_index: int, chunk_data: bytes, progress: float):
+        try:
+            chunk_urls.append(upload_audio_file_sync(
+                file_data=chunk_data,
+                filename=f"tracks/{track_id}/chunks/{chunk_index:03d}.wav",
+                content_type="audio/wav"
+            ))
+        except Exception as e:
+            logger.warning(f"Uploading chunk {chunk_index} of track {track_id} failed: {e}")
+            return
+        
+        task.update_state(
+            task_id=task_id,
+            state="PROGRESS",
+            meta={
+                "progress": 30 + int(progress * 30),
+                "message": f"Generating audio ({int(progress * 100)}%)...",
+                "chunk_urls": list(chunk_urls)
+            }
+        )
+    
+    # Leaving the block waits for the remaining chunk uploads
+    with ThreadPoolExecutor(max_workers=1) as uploader:
+        return generate_music_stream(
+            prompt=prompt,
+            on_chunk=lambda *chunk: uploader.submit(upload_chunk, *chunk),
+            duration=duration,
+            model=model,
+            time_budget=time_budget,
+            **sampling
+        )
+
+
+def _finalize_track(
+    track_id: str,
+    audio: Dict,
+    report_progress: Callable[[int, str], None],
+    tier: str = None
+) -> Dict:
+    """
+    Upload generated audio from memory and mark the track completed
+    
+    The track is completed as soon as the master is uploaded in its primary
+    format; the AUDIO_RENDITIONS formats are encoded afterwards and merged
+    into the track's audio_urls. Stems are separated off the critical path:
+    prefetched on the stems queue for STEM_PREFETCH_TIERS, otherwise on
+    first request.
+    """
+    # Upload to storage
+    report_progress(80, "Uploading files...")
+    
+    master_urls = upload_encoded_audio(f"tracks/{track_id}/master", audio, renditions=False)
+    audio_url = master_urls[audio["format"]]
+    
+    # Update track in database; audio_urls is only ever merged into, since
+    # alternates may already have recorded their renditions there
+    update_track_audio_urls(track_id, {"master": master_urls})
+    supabase.table("tracks").update({
+        "status": "completed",
+        "audio_url": audio_url,
+        "completed_at": "now()"
+    }).eq("id", track_id).execute()
+    
+    logger.info(f"Song generation completed for track {track_id}")
+    
+    report_progress(90, "Encoding renditions...")
+    
+    master_urls.update(upload_encoded_audio(f"tracks/{track_id}/master", audio, primary=False))
+    update_track_audio_urls(track_id, {"master": master_urls})
+    audio_urls = {"master": master_urls}
+    
+    prefetch_stems(track_id, tier)
+    
+    return {
+        "track_id": track_id,
+        "audio_url": audio_url,
+        "audio_urls": audio_urls,
+        "status": "completed"
+    }
+
+
+# Lifetime of a batch's processing list if its task is never redelivered
+BATCH_PROCESSING_TTL = 24 * 3600
+
+
+def _batch_key(model: str, temperature: float, tier: str = None) -> str:
+    """
+    Redis list holding pending jobs that can share one MusicGen pass
+    
+    Jobs are collected per tier so a batch runs under a single time budget.
+    """
+    return f"{get_batch_collector_prefix(model)}{temperature}:{(tier or 'default').lower()}"
+
+
+def _processing_key(batch_task_id: str) -> str:
+    """
+    Redis list holding the jobs a batch task has taken but not yet finalized
+    """
+    return f"grammy:song_batch_processing:{batch_task_id}"
+
+
+def _pop_batch(batch_key: str, batch_size: int, processing_key: str) -> List[Tuple[str, Dict]]:
+    """
+    Move up to batch_size pending jobs from the collector to a processing list
+    
+    Each job is moved atomically (LMOVE), so a batch task that is redelivered
+    after its worker died resumes the jobs it had already taken.
+    
+    Returns:
+        (raw job, job) pairs, raw as stored so it can be removed once finalized
+    """
+    redis = get_redis()
+    
+    raw_jobs = redis.lrange(processing_key, 0, -1)
+    if raw_jobs:
+        logger.info(f"Resuming {len(raw_jobs)} jobs of redelivered batch {processing_key}")
+    else:
+        for _ in range(batch_size):
+            raw_job = redis.lmove(batch_key, processing_key, "LEFT", "RIGHT")
+            if raw_job is None:
+                break
+            raw_jobs.append(raw_job)
+        if raw_jobs:
+            redis.expire(processing_key, BATCH_PROCESSING_TTL)
+    
+    return [(raw_job, json.loads(raw_job)) for raw_job in raw_jobs]
+
+
+def submit_song_generation(
+    track_id: str,
+    prompt: str,
+    duration: int,
+    model: str,
+    temperature: float,
+    seed: int = None,
+    tier: str = None,
+    num_return_sequences: int = 1
+) -> str:
+    """
+    Queue a song generation job and return the task id used for status polling
+    
+    When generation batching is enabled, jobs are held in a Redis collector
+    list per (model, temperature, tier) and dispatched to generate_song_batch_task
+    once GENERATION_BATCH_SIZE jobs are waiting or GENERATION_BATCH_WINDOW
+    seconds have passed since the first job arrived. Seeded jobs are never
+    batched, since their output must not depend on other prompts in a batch,
+    and neither are best-of-N jobs, which batch their own candidates.
+    """
+    # Unknown models are rejected here rather than failing on a worker
+    model = resolve_model_id(model)
+    queue = get_generation_queue(model)
+    
+    if seed is not None or num_return_sequences > 1 or not is_generation_batching_enabled():
+        task = generate_song_task.apply_async(
+            kwargs={
+                "track_id": track_id,
+                "prompt": prompt,
+                "duration": duration,
+                "model": model,
+                "temperature": temperature,
+                "seed": seed,
+                "tier": tier,
+                "num_return_sequences": num_return_sequences
+            },
+            queue=queue
+        )
+        return task.id
+    
+    # Each job gets its own task id so the batch can report per-track state
+    task_id = uuid()
+    job = {
+        "task_id": task_id,
+        "track_id": track_id,
+        "prompt": prompt,
+        "duration": duration,
+        "model": model,
+        "temperature": temperature,
+        "tier": tier
+    }
+    
+    batch_key = _batch_key(model, temperature, tier)
+    pending = get_redis().rpush(batch_key, json.dumps(job))
+    
+    if pending >= get_generation_batch_size():
+        # Batch is full, dispatch immediately
+        generate_song_batch_task.apply_async(args=[batch_key], queue=queue)
+    elif pending == 1:
+        # First job in an empty collector opens a new window
+        generate_song_batch_task.apply_async(
+            args=[batch_key],
+            queue=queue,
+            countdown=get_generation_batch_window()
+        )
+    
+    logger.info(f"Track {track_id} added to generation batch {batch_key} ({pending} pending)")
+    
+    return task_id
+
+
+@celery_app.task(bind=True, base=CallbackTask, name="workers.song_tasks.generate_song_batch_task")
+def generate_song_batch_task(self, batch_key: str):
+    """
+    Generate all jobs waiting in a collector list with one batched MusicGen pass
+    
+    Results are fanned back out to each track's row and to the task id that
+    was returned to the client when the job was submitted. Jobs stay in the
+    task's processing list until they are finalized, so a redelivery after a
+    worker crash picks them up again. The batch decodes under its tier's
+    generation time budget, like a single job.
+    """
+    processing_key = _processing_key(self.request.id)
+    taken = _pop_batch(batch_key, get_generation_batch_size(), processing_key)
+    jobs = [job for _, job in taken]
+    
+    if not jobs:
+        # Window expired after the batch had already been dispatched as full
+        return {"batch_key": batch_key, "tracks": [], "status": "empty"}
+    
+    logger.info(f"Starting batched generation of {len(jobs)} tracks from {batch_key}")
+    
+    for job in jobs:
+        self.backend.store_result(
+            job["task_id"],
+            {"progress": 30, "message": "Generating audio..."},
+            "PROGRESS"
+        )
+    
+    try:
+        audios = generate_music_batch(
+            prompts=[job["prompt"] for job in jobs],
+            durations=[job["duration"] for job in jobs],
+            model=jobs[0]["model"],
+            temperature=jobs[0]["temperature"],
+            time_budget=get_generation_time_budget(jobs[0].get("tier"))
+        )
+    except Exception as e:
+        logger.error(f"Batched song generation failed for {batch_key}: {e}")
+        
+        for job in jobs:
+            supabase.table("tracks").update({
+                "status": "failed",
+                "error_message": str(e)
+            }).eq("id", job["track_id"]).execute()
+            self.backend.mark_as_failure(job["task_id"], e)
+        get_redis().delete(processing_key)
+        
+        raise
+    
+    results = []
+    for (raw_job, job), audio in zip(taken, audios):
+        track_id = job["track_id"]
+        
+        def report_progress(progress: int, message: str, task_id: str = job["task_id"]):
+            self.backend.store_result(
+                task_id,
+                {"progress": progress, "message": message},
+                "PROGRESS"
+            )
+        
+        # One failed upload must not fail the other tracks in the batch
+        try:
+            result = _finalize_track(track_id, audio, report_progress, job.get("tier"))
+            self.backend.mark_as_done(job["task_id"], result)
+            results.append(result)
+        except Exception as e:
+            logger.error(f"Song generation failed for track {track_id}: {e}")
+            
+            supabase.table("tracks").update({
+                "status": "failed",
+                "error_message": str(e)
+            }).eq("id", track_id).execute()
+            self.backend.mark_as_failure(job["task_id"], e)
+            results.append({"track_id": track_id, "status": "failed"})
+        
+        get_redis().lrem(processing_key, 1, raw_job)
+    
+    logger.info(f"Batched generation completed for {len(jobs)} tracks from {batch_key}")
+    
+    return {"batch_key": batch_key, "tracks": results, "status": "completed"}
+
+
 @celery_app.task(bind=True, base=CallbackTask, name="workers.song_tasks.generate_vocals_task")
 def generate_vocals_task(
     self,
@@ -177,7 +580,7 @@ def generate_vocals_task(
         with open(vocal_path, "rb") as f:
             vocal_data = f.read()
         
-        vocal_url = upload_audio_file(
+        vocal_url = upload_audio_file_sync(
             file_data=vocal_data,
             filename=f"tracks/{track_id}/vocals.wav",
             content_type="audio/wav"
@@ -190,6 +593,11 @@ def generate_vocals_task(
             "has_vocals": True
         }).eq("id", track_id).execute()
         
+        # Renditions are encoded after the vocals are already available
+        vocal_urls = {"wav": vocal_url}
+        vocal_urls.update(upload_file_renditions(f"tracks/{track_id}/vocals", vocal_path, primary_format="wav"))
+        update_track_audio_urls(track_id, {"vocals": vocal_urls})
+        
         # Cleanup
         os.remove(vocal_path)
         
@@ -198,6 +606,7 @@ def generate_vocals_task(
         return {
             "track_id": track_id,
             "vocal_url": vocal_url,
+            "vocal_urls": vocal_urls,
             "status": "completed"
         }
     
@@ -0,0 +1,180 @@
+"""
+Celery tasks for deferred stem separation
+Stems are computed on a low-priority queue on first request (or prefetched
+for some tiers) and cached on the track row
+"""
+from celery.utils import uuid
+from workers.celery_app import celery_app
+from workers.base import CallbackTask
+from services.musicgen_service import generate_stems
+from services.supabase_client import supabase, update_track_audio_urls
+from services.encoding_service import AUDIO_FORMATS, select_rendition, upload_encoded_outputs
+from services.redis_client import get_redis
+from utils.config import get_output_audio_format, get_stem_prefetch_tiers
+from typing import Dict, Optional
+import io
+import logging
+import requests
+import soundfile as sf
+
+logger = logging.getLogger(__name__)
+
+STEMS_QUEUE = "stems"
+
+# Dispatch guard lifetime, matching the Celery hard time limit
+STEMS_DISPATCH_TTL = 3600
+
+
+def _dispatch_key(track_id: str) -> str:
+    """
+    Redis key holding the id of the stems task queued for a track
+    """
+    return f"grammy:stems:{track_id}"
+
+
+def request_stems(track_id: str) -> str:
+    """
+    Queue stem separation for a track unless it is already queued or running
+    
+    Returns:
+        Id of the stems task working on the track
+    """
+    task_id = uuid()
+    redis = get_redis()
+    
+    # Concurrent requests for the same track share one task
+    if not redis.set(_dispatch_key(track_id), task_id, nx=True, ex=STEMS_DISPATCH_TTL):
+        existing = redis.get(_dispatch_key(track_id))
+        if existing is not None:
+            return existing.decode()
+    
+    supabase.table("tracks").update({"stems_status": "queued"}).eq("id", track_id).execute()
+    separate_stems_task.apply_async(args=[track_id], task_id=task_id, queue=STEMS_QUEUE)
+    
+    logger.info(f"Stem separation queued for track {track_id} (task {task_id})")
+    
+    return task_id
+
+
+def prefetch_stems(track_id: str, tier: Optional[str] = None):
+    """
+    Queue stem separation right after generation for STEM_PREFETCH_TIERS
+    """
+    tiers = get_stem_prefetch_tiers()
+    if "all" not in tiers and (tier or "").lower() not in tiers:
+        return
+    
+    # A failed prefetch must not fail the finished track; stems stay on demand
+    try:
+        request_stems(track_id)
+    except Exception as e:
+        logger.warning(f"Stem prefetch failed for track {track_id}: {e}")
+
+
+def _download_master(track: Dict) -> Dict:
+    """
+    Download and decode a track's master, preferring a lossless rendition
+    
+    Returns:
+        Decoded audio with the OUTPUT_AUDIO_FORMAT its stems are encoded in
+    """
+    renditions = (track.get("audio_urls") or {}).get("master") or {}
+    selected = select_rendition(renditions, lossless=True)
+    if selected is None:
+        # Lossy-only tracks and tracks generated before renditions were uploaded
+        extension = track["audio_url"].rsplit("?", 1)[0].rsplit(".", 1)[-1].lower()
+        selected = (extension if extension in AUDIO_FORMATS else "wav", track["audio_url"])
+    
+    _, url = selected
+    response = requests.get(url, timeout=60)
+    response.raise_for_status()
+    
+    audio_array, sample_rate = sf.read(io.BytesIO(response.content), dtype="float32")
+    
+    audio_format = get_output_audio_format()
+    return {
+        "audio": audio_array,
+        "sample_rate": sample_rate,
+        "format": audio_format,
+        "content_type": AUDIO_FORMATS[audio_format]["content_type"]
+    }
+
+
+@celery_app.task(bind=True, base=CallbackTask, name="workers.stem_tasks.separate_stems_task")
+def separate_stems_task(self, track_id: str):
+    """
+    Separate a completed track into stems and cache their URLs on the track row
+    """
+    try:
+        track = supabase.table("tracks").select("audio_url, audio_urls, stem_urls").eq("id", track_id).single().execute()
+        
+        if not track.data or not track.data.get("audio_url"):
+            raise ValueError(f"Track {track_id} audio not found")
+        
+        if track.data.get("stem_urls"):
+            logger.info(f"Stems for track {track_id} already separated")
+            return {"track_id": track_id, "stem_urls": track.data["stem_urls"], "status": "completed"}
+        
+        logger.info(f"Starting stem separation for track {track_id}")
+        
+        supabase.table("tracks").update({"stems_status": "processing"}).eq("id", track_id).execute()
+        
+        self.update_state(
+            state="PROGRESS",
+            meta={"progress": 10, "message": "Downloading audio..."}
+        )
+        
+        audio = _download_master(track.data)
+        
+        self.update_state(
+            state="PROGRESS",
+            meta={"progress": 30, "message": "Separating stems..."}
+        )
+        
+        stems = generate_stems(audio)
+        
+        self.update_state(
+            state="PROGRESS",
+            meta={"progress": 70, "message": "Uploading stems..."}
+        )
+        
+        # All stems and their renditions are encoded and uploaded concurrently
+        uploaded = upload_encoded_outputs({
+            f"tracks/{track_id}/stems/{stem_name}": stem for stem_name, stem in stems.items()
+        })
+        
+        stem_urls = {}
+        audio_urls = {}
+        for stem_name, stem in stems.items():
+            urls = uploaded[f"tracks/{track_id}/stems/{stem_name}"]
+            stem_urls[stem_name] = urls[stem["format"]]
+            audio_urls[f"stems/{stem_name}"] = urls
+        
+        update_track_audio_urls(track_id, audio_urls)
+        supabase.table("tracks").update({
+            "stem_urls": stem_urls,
+            "stems_status": "completed"
+        }).eq("id", track_id).execute()
+        
+        logger.info(f"Stem separation completed for track {track_id}")
+        
+        return {
+            "track_id": track_id,
+            "stem_urls": stem_urls,
+            "audio_urls": audio_urls,
+            "status": "completed"
+        }
+    
+    except Exception as e:
+        logger.error(f"Stem separation failed for track {track_id}: {e}")
+        
+        # The track itself is still usable; only its stems failed
+        supabase.table("tracks").update({
+            "stems_status": "failed"
+        }).eq("id", track_id).execute()
+        
+        raise
+    
+    finally:
+        # Later requests either find the cached stems or queue a retry
+        get_redis().delete(_dispatch_key(track_id))
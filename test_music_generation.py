@@ -90,6 +90,7 @@ def test_music_generation():
     try:
         from services.musicgen_service import generate_music
         import tempfile
+        import io
         
         # Generate a short test track
         prompt = "upbeat electronic dance music, 120 BPM"
@@ -98,39 +99,33 @@ def test_music_generation():
         print(f"  Generating 5-second test track...")
         print(f"  Prompt: '{prompt}'")
         
-        output_path = generate_music(
+        result = generate_music(
             prompt=prompt,
             duration=duration,
             model='small',  # Use small model for faster testing
             temperature=1.0
         )
         
-        if os.path.exists(output_path):
-            file_size = os.path.getsize(output_path)
-            print(f"✓ Audio file generated: {output_path}")
-            print(f"  File size: {file_size:,} bytes")
+        if result["data"]:
+            print(f"✓ Audio generated in memory ({result['format']})")
+            print(f"  Encoded size: {len(result['data']):,} bytes")
             
             # Verify it's a valid audio file
-            import wave
+            import soundfile as sf
             try:
-                with wave.open(output_path, 'rb') as wav_file:
-                    frames = wav_file.getnframes()
-                    rate = wav_file.getframerate()
-                    duration_actual = frames / float(rate)
-                    print(f"  Duration: {duration_actual:.2f}s")
-                    print(f"  Sample rate: {rate} Hz")
-                    print(f"  Channels: {wav_file.getnchannels()}")
+                info = sf.info(io.BytesIO(result["data"]))
+                print(f"  Duration: {info.duration:.2f}s")
+                print(f"  Sample rate: {info.samplerate} Hz")
+                print(f"  Channels: {info.channels}")
                 
-                # Clean up
-                os.remove(output_path)
                 print("\n✓ Music generation test PASSED!\n")
                 return True
                 
             except Exception as e:
-                print(f"✗ Generated file is not valid WAV: {e}")
+                print(f"✗ Generated data is not valid audio: {e}")
                 return False
         else:
-            print("✗ Audio file not generated")
+            print("✗ Audio not generated")
             return False
             
     except Exception as e: